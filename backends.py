@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Registry of interchangeable implementations of the rps update.
+
+Every backend runs the same rule, given as dict with the rule arguments of
+rps.simulate():
+    number_of_weapons, weapon_range, loss_threshold, fixed_threshold,
+    overlap_x, overlap_y, nh_seed, nh_order, new_image
+The per-pixel implementation of rps.py is the reference, the differential
+test compares every other backend against it.
+"""
+import os
+import random
+import sys
+from abc import ABC, abstractmethod
+
+import numpy as np
+from PIL import Image
+
+import rps
+import packed
+
+# NAME -> backend class, filled by register()
+BACKENDS = {}
+
+
+def register(cls):
+    """Class decorator adding a backend to BACKENDS."""
+    BACKENDS[cls.NAME] = cls
+    return cls
+
+
+class Backend(ABC):
+    """Base class of the rps backends."""
+
+    """Name used by --backend."""
+    NAME = None
+    """Higher is preferred by select_backend(), None is never selected automatically."""
+    PRIORITY = None
+    """Whether or not only some iterations are yielded."""
+    SPARSE = False
+    """Options of __init__() the backend honours, get_backend() rejects the others."""
+    OPTIONS = ()
+
+    def __init__(self, **options):
+        """Keep the backend specific options, None leaves an option unset.
+
+            threads:    (int) Number of bands/threads.
+            log_dist:   (int) Progress is reported in LOG_DIST % steps.
+            packed:     (bool) Keep the grid bit-packed.
+            hashlife:   (int) Only every 2**hashlife-th iteration is computed.
+        """
+        self.options = options
+
+    @classmethod
+    def available(cls):
+        """Whether or not the backend can run on this machine."""
+        return True
+
+    @classmethod
+    @abstractmethod
+    def supports(cls, rule):
+        """Whether or not the backend implements the rule."""
+
+    @abstractmethod
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        """Run the rule from `grid` (weapon indices, not modified).
+
+            YIELDS
+            (iteration, numpy.ndarray) The state after (at least) every
+            iteration the backend computes, up to and including `iterations`.
+            The state may be reused by the backend, see to_grid().
+        """
+
+    def to_grid(self, state):
+        """Weapon indices of a yielded state, only needed where it is rendered."""
+        return state
+
+
+@register
+class ReferenceBackend(Backend):
+    """The per-pixel update of rps.defend_against_neighbours()."""
+
+    NAME = "reference"
+    PRIORITY = 0
+    OPTIONS = ("log_dist",)
+
+    @classmethod
+    def supports(cls, rule):
+        return True
+
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        log_dist = self.options.get("log_dist")
+        img = Image.frombytes("P", (grid.shape[1], grid.shape[0]), grid.tobytes())
+        total_pixels = img.width * img.height
+        loss_threshold = rule["loss_threshold"]
+
+        if rule["new_image"] == 2:
+            # colour classes one after another, see rps.step_coloured()
+            coordinates = [
+                (x, y)
+                for ys in rps.colour_classes(img.height, rule["overlap_y"])
+                for xs in rps.colour_classes(img.width, rule["overlap_x"])
+                for y in ys.tolist()
+                for x in xs.tolist()
+            ]
+        else:
+            coordinates = list(np.ndindex(img.size))
+
+        for iteration in range(first_iteration, iterations + 1):
+            # change loss threshold based on iteration
+            if not rule["fixed_threshold"]:
+                loss_threshold = iteration % rule["loss_threshold"]
+
+            # The source image to look up weapons
+            img_ref=None
+            if rule["new_image"] == 1:
+                # store previous values separately
+                img_ref = img.copy()
+            else:
+                # read values from the changing image
+                img_ref = img
+
+            finished_pixels = 0
+            current_progress = -1
+
+            # loop over coordinates
+            for x, y in coordinates:
+                # log progress
+                if log_dist is not None:
+                    progress = (finished_pixels / total_pixels) * 100
+                    if current_progress != progress and ( progress % log_dist) == 0:
+                        current_progress = progress
+                        print("\tPixel {}/{}".format(
+                            "0"*(len(str(total_pixels)) - len(str(finished_pixels))) + str(finished_pixels),
+                            total_pixels
+                        ))
+
+                # set each pixel by channel
+                img.putpixel(
+                    xy=(x,y),
+                    value=rps.defend_against_neighbours(
+                        xy=(x,y),
+                        src=img_ref,
+                        number_of_weapons=rule["number_of_weapons"],
+                        weapon_range=rule["weapon_range"],
+                        loss_threshold=loss_threshold,
+                        overlap_x=rule["overlap_x"],
+                        overlap_y=rule["overlap_y"],
+                        nh_seed=rule["nh_seed"],
+                        nh_order=rule["nh_order"],
+                    )
+                )
+                finished_pixels += 1
+
+            yield iteration, np.array(img)
+
+
+@register
+class NumpyBackend(Backend):
+    """The vectorized update of rps.step() / rps.step_coloured()."""
+
+    NAME = "numpy"
+    PRIORITY = 20
+
+    @classmethod
+    def supports(cls, rule):
+        return rule["new_image"] in [1, 2]
+
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        yield from rps.simulate(grid, iterations, first_iteration=first_iteration, **rule)
+
+
+@register
+class ThreadsBackend(Backend):
+    """The vectorized update, split into bands on a thread pool."""
+
+    NAME = "threads"
+    # no measured speedup over numpy yet, used with --threads / --backend threads
+    PRIORITY = 15
+    OPTIONS = ("threads",)
+
+    @classmethod
+    def supports(cls, rule):
+        return rule["new_image"] in [1, 2]
+
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        from concurrent.futures import ThreadPoolExecutor
+        threads = self.options.get("threads") or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            yield from rps.simulate(
+                grid, iterations,
+                first_iteration=first_iteration,
+                pool=pool, bands=threads,
+                **rule
+            )
+
+
+@register
+class PackedBackend(Backend):
+    """The vectorized update on bit-packed weapon indices (see packed.py)."""
+
+    NAME = "packed"
+    PRIORITY = 10
+    OPTIONS = ("packed",)
+
+    @classmethod
+    def supports(cls, rule):
+        return rule["new_image"] == 1 and rule["number_of_weapons"] <= 16
+
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        # states stay packed, to_grid() unpacks them to be rendered
+        self.width = grid.shape[1]
+        self.bits = packed.bits_per_cell(rule["number_of_weapons"])
+        yield from rps.simulate(
+            grid, iterations,
+            first_iteration=first_iteration,
+            packed=True,
+            **rule
+        )
+
+    def to_grid(self, state):
+        return packed.unpack(state, self.width, self.bits)
+
+
+@register
+class HashLifeBackend(Backend):
+    """The memoized quadtree engine of hashlife.py, yields sparse iterations."""
+
+    NAME = "hashlife"
+    PRIORITY = None
+    SPARSE = True
+    OPTIONS = ("hashlife",)
+
+    @classmethod
+    def supports(cls, rule):
+        return (
+            rule["new_image"] == 1
+            and rule["fixed_threshold"]
+            and rule["overlap_x"] and rule["overlap_y"]
+        )
+
+    def simulate(self, grid, iterations, rule, first_iteration=1):
+        yield from rps.simulate(
+            grid, iterations,
+            first_iteration=first_iteration,
+            hashlife=self.options.get("hashlife") or 0,
+            **rule
+        )
+
+
+def select_backend(rule):
+    """The name of the preferred available backend supporting the rule.
+
+        Only the fixed PRIORITY of each backend and its supports() are
+        considered, the preference does not depend on the number of
+        weapons, the neighbourhood or the grid size.
+    """
+    candidates = [
+        cls for cls in BACKENDS.values()
+        if cls.PRIORITY is not None and cls.available() and cls.supports(rule)
+    ]
+    return max(candidates, key=lambda cls: cls.PRIORITY).NAME
+
+
+def get_backend(name, rule, **options):
+    """Instantiate a backend by name ("auto" -> select_backend()).
+
+        RETURNS
+        (Backend) The backend, ValueError if it does not support the rule
+        or one of the options that are not None.
+    """
+    if name == "auto":
+        name = select_backend(rule)
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend '{}', choose from {}".format(name, list(BACKENDS)))
+    cls = BACKENDS[name]
+    if not cls.supports(rule):
+        raise ValueError("Backend '{}' does not support this configuration.".format(name))
+    ignored = [key for key, value in options.items() if value is not None and key not in cls.OPTIONS]
+    if ignored:
+        raise ValueError("Backend '{}' does not support the option(s) {}.".format(name, ", ".join(ignored)))
+    return cls(**options)
+
+
+# DIFFERENTIAL TEST =================================================
+def random_rule(rng):
+    """A random rule configuration."""
+    number_of_weapons = rng.randint(2, 20)
+    return {
+        "number_of_weapons": number_of_weapons,
+        "weapon_range": (rng.randint(0, number_of_weapons), rng.randint(0, number_of_weapons)),
+        "loss_threshold": rng.randint(1, 4),
+        "fixed_threshold": rng.randint(0, 1),
+        "overlap_x": rng.randint(0, 1),
+        "overlap_y": rng.randint(0, 1),
+        "nh_seed": "".join(rng.choice("01") for _ in range(rps.NUM_NEIGHBOURS)),
+        "nh_order": "".join(str(i) for i in rng.sample(range(rps.NUM_NEIGHBOURS), rps.NUM_NEIGHBOURS)),
+        "new_image": rng.randint(0, 2),
+    }
+
+
+def differential_test(seed=None, size=(12, 16), iterations=8):
+    """Run a random configuration through every backend and compare with the reference.
+
+        OPTIONALS
+        seed:
+            (int)
+            Seed of the random configuration and grid.
+        size:
+            (pair(int,int))
+            (HEIGHT, WIDTH) of the random grid.
+        iterations:
+            (int)
+            Number of iterations to compare.
+
+        RETURNS
+        (dict) backend name -> None if identical, else the first difference
+        (iteration, y, x, reference value, backend value).
+        Backends not supporting the configuration are left out.
+    """
+    rng = random.Random(seed)
+    rule = random_rule(rng)
+    grid = np.array(
+        [[rng.randrange(rule["number_of_weapons"]) for _ in range(size[1])] for _ in range(size[0])],
+        dtype=np.uint8
+    )
+    print("> Rule:\n  : " + str(rule))
+
+    reference = {
+        iteration: current.copy()
+        for iteration, current in ReferenceBackend().simulate(grid, iterations, rule)
+    }
+
+    report = {}
+    for name, cls in BACKENDS.items():
+        if cls is ReferenceBackend or not cls.available() or not cls.supports(rule):
+            continue
+        report[name] = None
+        backend = cls(threads=3, hashlife=1)
+        for iteration, state in backend.simulate(grid, iterations, rule):
+            current = backend.to_grid(state)
+            differing = np.argwhere(current != reference[iteration])
+            if len(differing):
+                y, x = differing[0]
+                report[name] = (
+                    iteration, int(y), int(x),
+                    int(reference[iteration][y, x]), int(current[y, x])
+                )
+                break
+        if report[name] is None:
+            print("  {}: identical".format(name))
+        else:
+            print("  {}: differs at iteration {} (y={}, x={}): reference {} != {}".format(name, *report[name]))
+    return report
+
+
+# ENTRY =============================================================
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) not in [0, 1, 2] or "-h" in args or "--help" in args:
+        print("Usage:   python3 backends.py [runs] [seed]")
+        print("            [runs] : number of random configurations to test (default 10)")
+        print("            [seed] : seed of the first configuration")
+        sys.exit()
+
+    runs = int(args[0]) if len(args) > 0 else 10
+    first_seed = int(args[1]) if len(args) > 1 else random.randrange(1 << 30)
+
+    print("Backends: " + ", ".join(
+        "{} ({})".format(name, "available" if cls.available() else "unavailable")
+        for name, cls in BACKENDS.items()
+    ))
+    failures = 0
+    for seed in range(first_seed, first_seed + runs):
+        print("Seed {}:".format(seed))
+        report = differential_test(seed)
+        failures += sum(difference is not None for difference in report.values())
+    print("{} differing backend runs.".format(failures))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Run rps on many seed images or video frames in one process tree.
+
+Inputs are streamed through three stages, each running on its own group of
+worker processes connected by bounded queues:
+    decode   : load and discretize the seed image
+    simulate : run the vectorized rule, passing on chunks of frames
+    encode   : write the frames, gif and statistics of each input
+All chunks of an input go to the same encoding process, which keeps the gif
+and statistics of the input open until its last chunk arrives. An input that
+fails in any stage is passed on as Failed, the encoding process then removes
+whatever it already wrote of that input.
+"""
+import os
+import shutil
+import time
+import traceback
+import zlib
+import multiprocessing as mp
+
+import numpy as np
+from PIL import Image
+
+import rps
+import packed
+from gif import GifWriter
+from stats import RunStats
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp"]
+VIDEO_EXTENSIONS = [".mp4", ".avi", ".mov", ".mkv", ".webm"]
+
+
+class Failed():
+    """Passed down the pipeline in place of an input that raised."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def iter_inputs(paths):
+    """Yield (name, image path or RGB array) for every input.
+
+        Directories yield their images in sorted order, videos yield one
+        input per decoded frame.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_inputs(sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+            ))
+            continue
+
+        name, extension = os.path.splitext(os.path.basename(path))
+        if extension.lower() in VIDEO_EXTENSIONS:
+            # only needed for videos
+            import imageio
+            reader = imageio.get_reader(path)
+            digits = len(str(max(reader.count_frames(), 1)))
+            for number, frame in enumerate(reader):
+                yield "{}-{}".format(name, str(number).zfill(digits)), frame
+            reader.close()
+        else:
+            yield name, path
+
+
+def unique_names(items):
+    """Rename inputs whose name is already taken by appending -2, -3, ...
+
+        Names are compared ignoring case, as the outputs of both would end
+        up in the same directory on case-insensitive file systems.
+    """
+    used = set()
+    for name, src in items:
+        unique = name
+        suffix = 1
+        while unique.lower() in used:
+            suffix += 1
+            unique = "{}-{}".format(name, suffix)
+        if unique != name:
+            print("Warning: name '{}' is already used, writing {} to '{}'".format(
+                name, src if isinstance(src, str) else "a video frame", unique
+            ))
+        used.add(unique.lower())
+        yield unique, src
+
+
+def decode(item, rule):
+    """Load and discretize one input, RETURNS (name, weapon indices, palette)."""
+    name, src = item
+    img = Image.open(src) if isinstance(src, str) else Image.fromarray(np.asarray(src))
+    img, _ = rps.discretize(img.convert("RGB"), rule["number_of_weapons"])
+    return name, np.array(img), rps.weapon_palette(img, rule["number_of_weapons"])
+
+
+def simulate(item, rule, chunk_size):
+    """Simulate one input.
+
+        YIELDS
+        (name, first frame number, frames, palette, width, last) for every
+        chunk of up to chunk_size frames, starting with the seed. Frames stay
+        bit-packed if the rule is packed.
+    """
+    name, grid, palette = item
+    width = grid.shape[1]
+    total = rule["iterations"] + 1
+    first = grid
+    if rule.get("packed"):
+        first = packed.pack(grid, packed.bits_per_cell(rule["number_of_weapons"]))
+    number = 0
+    chunk = [first]
+    steps = rps.simulate(grid, **rule)
+    while True:
+        if len(chunk) == chunk_size or number + len(chunk) == total:
+            last = number + len(chunk) == total
+            yield name, number, np.stack(chunk), palette, width, last
+            if last:
+                return
+            number += len(chunk)
+            chunk = []
+        # the engine reuses its buffers
+        chunk.append(next(steps)[1].copy())
+
+
+def encode(item, out_dir, rule, regions_every, runs):
+    """Write a chunk of frames of one input below out_dir.
+
+        runs:
+            (dict)
+            Inputs of this process still waiting for chunks, name -> state.
+
+        RETURNS
+        (str) The name of the input after its last chunk, else None.
+    """
+    name, number, frames, palette, width, last = item
+    loc_path = os.path.join(out_dir, name)
+    if number == 0:
+        os.makedirs(loc_path, exist_ok=True)
+        runs[name] = {
+            # already on its own process
+            "gif": GifWriter(loc_path + ".gif", (width, frames.shape[1]), palette, background=False),
+            "stats": RunStats(len(palette) // 3, regions_every=regions_every),
+            "previous": None,
+        }
+    run = runs[name]
+    if run is None:
+        # the input already failed in this process
+        return None
+    for number, current in enumerate(frames, number):
+        # packed frames are only unpacked to be rendered
+        if rule.get("packed"):
+            current = packed.unpack(current, width, packed.bits_per_cell(rule["number_of_weapons"]))
+        rps.to_image(current, palette).save(
+            rps.gen_file_name(loc_path, number, rule["iterations"] + 1),
+            "PNG"
+        )
+        run["gif"].add_frame(current)
+        run["stats"].record(number, current, run["previous"])
+        run["previous"] = current
+
+    if not last:
+        return None
+    del runs[name]
+    run["gif"].close()
+    run["stats"].save(loc_path + ".stats.npz")
+    return name
+
+
+def discard(name, out_dir, rule, regions_every, runs):
+    """Remove the partial outputs of a failed input.
+
+        Later chunks of the input are ignored by encode().
+
+        RETURNS
+        (bool) False if the failure of the input was already reported.
+    """
+    if name in runs and runs[name] is None:
+        return False
+    run = runs.get(name)
+    runs[name] = None
+    if run is not None:
+        loc_path = os.path.join(out_dir, name)
+        run["gif"].close()
+        os.remove(loc_path + ".gif")
+        shutil.rmtree(loc_path, ignore_errors=True)
+    return True
+
+
+def _stage_worker(function, args, in_queue, out_queue, last, on_failure=None):
+    def put(result):
+        if isinstance(out_queue, list):
+            # all results of an input go to the same worker
+            name = result.name if isinstance(result, Failed) else result[0]
+            out_queue[zlib.crc32(name.encode()) % len(out_queue)].put(result)
+        else:
+            out_queue.put(result)
+
+    def fail(name):
+        if on_failure is None or on_failure(name, *args):
+            put(Failed(name))
+
+    # process items until the sentinel arrives
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        if isinstance(item, Failed):
+            fail(item.name)
+            continue
+        try:
+            results = function(item, *args)
+            # stages either return one result or yield several
+            if not hasattr(results, "__next__"):
+                results = [results]
+            for result in results:
+                if result is not None:
+                    put(result)
+        except Exception:
+            # report the failed input, keep the pipeline running
+            traceback.print_exc()
+            fail(item[0])
+    # the last stage reports its end to the main process
+    if last:
+        out_queue.put(None)
+
+
+def run_batch(
+    paths,
+    out_dir,
+    rule,
+    decode_workers=1,
+    simulate_workers=None,
+    encode_workers=1,
+    queue_size=2,
+    regions_every=100,
+    chunk_size=16,
+):
+    """Stream all inputs through the decode, simulate and encode stages.
+
+        paths:
+            (list(str))
+            Images, directories of images and videos.
+        out_dir:
+            (str)
+            Outputs of each input are written to out_dir/<input name>.
+        rule:
+            (dict)
+            Keyword arguments of rps.simulate() except grid.
+
+        OPTIONALS
+        decode_workers, simulate_workers, encode_workers:
+            (int)
+            Number of processes of each stage. simulate_workers defaults to
+            the cores not used by the other stages.
+        queue_size:
+            (int)
+            Maximum number of inputs (or chunks) waiting in front of each
+            stage (or encoding process).
+        regions_every:
+            (int)
+            See stats.RunStats.
+        chunk_size:
+            (int)
+            Number of frames passed from simulation to encoding at once.
+            Together with queue_size it bounds the frames held in memory,
+            independent of the number of iterations.
+
+        RETURNS
+        (list(str)) The names of the finished inputs, failed inputs are
+        reported and left out.
+    """
+    if simulate_workers is None:
+        simulate_workers = max(1, mp.cpu_count() - decode_workers - encode_workers)
+    os.makedirs(out_dir, exist_ok=True)
+
+    to_decode = mp.Queue(queue_size)
+    to_simulate = mp.Queue(queue_size)
+    # one queue per encoding process
+    to_encode = [mp.Queue(queue_size) for _ in range(encode_workers)]
+    finished = mp.Queue()
+
+    stages = [
+        (decode, (rule,), to_decode, to_simulate, decode_workers, None),
+        (simulate, (rule, chunk_size), to_simulate, to_encode, simulate_workers, None),
+        (encode, (out_dir, rule, regions_every, {}), to_encode, finished, encode_workers, discard),
+    ]
+    workers = []
+    for function, args, in_queue, out_queue, count, on_failure in stages:
+        last = out_queue is finished
+        workers.append([
+            mp.Process(target=_stage_worker, args=(
+                function, args,
+                in_queue[number] if isinstance(in_queue, list) else in_queue,
+                out_queue, last, on_failure
+            ))
+            for number in range(count)
+        ])
+        for worker in workers[-1]:
+            worker.start()
+
+    start = time.time()
+    names = []
+    failed = []
+    for item in unique_names(iter_inputs(paths)):
+        to_decode.put(item)
+    # close each stage once the one before it is done
+    for (_, _, in_queue, out_queue, count, _), stage_workers in zip(stages, workers):
+        for number in range(count):
+            (in_queue[number] if isinstance(in_queue, list) else in_queue).put(None)
+        if out_queue is finished:
+            ended = 0
+            while ended < count:
+                name = finished.get()
+                if name is None:
+                    ended += 1
+                elif isinstance(name, Failed):
+                    failed.append(name.name)
+                else:
+                    names.append(name)
+        for worker in stage_workers:
+            worker.join()
+
+    elapsed = time.time() - start
+    print("Finished {} inputs in {:.1f}s ({:.1f} images/hour), {} failed".format(
+        len(names),
+        elapsed,
+        len(names) / elapsed * 3600 if elapsed > 0 else 0,
+        len(failed)
+    ))
+    if failed:
+        print("  : Failed: " + ", ".join(failed))
+    return names
+
+
+# ENTRY =============================================================
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Input images, directories of images or videos."
+    )
+    parser.add_argument(
+        "--out",
+        metavar="OUT_DIR",
+        dest="out_dir",
+        help="Directory receiving one output directory per input.",
+        default="rps-batch",
+        type=str
+    )
+    parser.add_argument(
+        "--i",
+        metavar="ITERATIONS",
+        dest="iterations",
+        help="The number of iterations to run.",
+        default=100,
+        type=int
+    )
+    parser.add_argument(
+        "--nw",
+        metavar="NUMBER_OF_WEAPONS",
+        dest="number_of_weapons",
+        help="The number of weapons/colorlevels.",
+        default=3,
+        type=int
+    )
+    parser.add_argument(
+        "--wr-pre",
+        metavar="PRE",
+        dest="wr_pre",
+        help="Each defender can survive attacks by its PRE previous neighbours.",
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        "--wr-post",
+        metavar="POST",
+        dest="wr_post",
+        help="Each defender can survive attacks by its POST following neighbours.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--lt",
+        metavar="LOSS_THRESHOLD",
+        dest="loss_threshold",
+        help="Defender needs to loose LOSS_THRESHOLD matches to be replaced.",
+        default=2,
+        type=int
+    )
+    parser.add_argument(
+        "--f-lt",
+        metavar="FIXED_THRESHOLD",
+        dest="fixed_threshold",
+        help="Whether or not to cycle 0..LOSS_THRESHOLD (0/1)",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--overlap_x",
+        metavar="OVERLAP_x",
+        dest="overlap_x",
+        help="Whether or not (1/0) the x-borders should wrap.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--overlap_y",
+        metavar="OVERLAP_Y",
+        dest="overlap_y",
+        help="Whether or not (1/0) the y-borders should wrap.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--nh-seed",
+        metavar="SEED",
+        dest="nh_seed",
+        help="Neighbourhood seed, see rps.py.",
+        default="01010101",
+        type=str
+    )
+    parser.add_argument(
+        "--nh-order",
+        metavar="ORDER",
+        dest="nh_order",
+        help="Neighbourhood ordering number, see rps.py.",
+        default="01234567",
+        type=str
+    )
+    parser.add_argument(
+        "--new-image",
+        metavar="NEW_IMAGE",
+        dest="new_image",
+        help="1 calculates from a copy of the picture, 2 updates the same image in colour classes.",
+        default=1,
+        choices=[1, 2],
+        type=int
+    )
+    parser.add_argument(
+        "--packed",
+        metavar="PACKED",
+        dest="packed",
+        help="Whether or not (1/0) to keep the grids bit-packed. Requires --new-image 1 and --nw <= 16.",
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        "--decoders",
+        metavar="N",
+        dest="decode_workers",
+        help="Number of decoding processes.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--simulators",
+        metavar="N",
+        dest="simulate_workers",
+        help="Number of simulating processes. (None->remaining cores)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--encoders",
+        metavar="N",
+        dest="encode_workers",
+        help="Number of encoding processes.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--queue-size",
+        metavar="N",
+        dest="queue_size",
+        help="Maximum number of inputs waiting in front of each stage.",
+        default=2,
+        type=int
+    )
+    parser.add_argument(
+        "--regions-every",
+        metavar="K",
+        dest="regions_every",
+        help="Count connected regions every K iterations for the statistics. (0->never)",
+        default=100,
+        type=int
+    )
+    parser.add_argument(
+        "--chunk-size",
+        metavar="N",
+        dest="chunk_size",
+        help="Number of frames passed from simulation to encoding at once.",
+        default=16,
+        type=int
+    )
+    args = parser.parse_args()
+
+    print(args)
+
+    run_batch(
+        args.paths,
+        args.out_dir,
+        rule={
+            "iterations": args.iterations,
+            "number_of_weapons": args.number_of_weapons,
+            "weapon_range": (args.wr_pre, args.wr_post),
+            "loss_threshold": args.loss_threshold,
+            "fixed_threshold": args.fixed_threshold,
+            "overlap_x": args.overlap_x,
+            "overlap_y": args.overlap_y,
+            "nh_seed": rps.parse_nh_seed(args.nh_seed),
+            "nh_order": rps.parse_nh_order(args.nh_order),
+            "new_image": args.new_image,
+            "packed": args.packed,
+        },
+        decode_workers=args.decode_workers,
+        simulate_workers=args.simulate_workers,
+        encode_workers=args.encode_workers,
+        queue_size=args.queue_size,
+        regions_every=args.regions_every,
+        chunk_size=args.chunk_size,
+    )
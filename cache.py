@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Content-addressed cache of simulated frame sequences.
+
+Each entry is keyed by the hash of the input image, the rule parameters and
+the engine version, and holds the frames 0..n of that run. Entries are
+only ever extended at the end, least recently used entries are evicted as
+soon as the cache grows beyond its disk budget. Frames can only be appended
+in order, so runs that skip iterations (e.g. rps.py --hashlife) cannot be
+cached.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+class RunCache():
+    """Frame sequences of earlier runs, stored below `cache_dir`."""
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        """Open (and create) the cache.
+
+            cache_dir:
+                (str)
+                Directory holding one sub-directory per entry.
+
+            OPTIONALS
+            max_bytes:
+                (int)
+                Disk budget, enforced by evict().
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # bytes stored, known after the first evict()
+        self.total = None
+        # keys not extended any more, their entry alone exceeds max_bytes
+        self.full = set()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(img_path, params):
+        """Hash of the input image contents and the (json-serializable) parameters."""
+        digest = hashlib.sha256()
+        with open(img_path, "rb") as img_file:
+            for chunk in iter(lambda: img_file.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _frame(self, key, number):
+        return os.path.join(self._entry(key), "{}.png".format(number))
+
+    def frames(self, key):
+        """Paths of the cached frames 0..n of `key`, marks the entry as used."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return []
+        paths = []
+        while os.path.isfile(self._frame(key, len(paths))):
+            paths.append(self._frame(key, len(paths)))
+        self._touch(key)
+        return paths
+
+    def append(self, key, number, file_name, params=None):
+        """Store the saved frame `number` of `key`.
+
+            Only the frame directly following the cached ones is stored, so an
+            entry always holds a gapless prefix of the run. Other entries are
+            evicted as soon as the cache exceeds max_bytes; once the entry of
+            `key` alone exceeds it, no further frames of it are stored.
+        """
+        if key in self.full:
+            return
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            os.mkdir(entry)
+            with open(os.path.join(entry, "params.json"), "w") as params_file:
+                json.dump(params, params_file, sort_keys=True)
+        if number > 0 and not os.path.isfile(self._frame(key, number - 1)):
+            return
+        if os.path.isfile(self._frame(key, number)):
+            return
+        shutil.copyfile(file_name, self._frame(key, number))
+        self._touch(key)
+
+        if self.total is None:
+            self.evict(keep=key)
+        else:
+            self.total += os.path.getsize(self._frame(key, number))
+            if self.total > self.max_bytes:
+                self.evict(keep=key)
+        if self.total > self.max_bytes:
+            print("\tCache entry exceeds {} bytes, not caching further frames".format(self.max_bytes))
+            self.full.add(key)
+
+    def _touch(self, key):
+        # the modification time of the params file records the last use
+        params_path = os.path.join(self._entry(key), "params.json")
+        if os.path.isfile(params_path):
+            os.utime(params_path, (time.time(), time.time()))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes.
+
+            keep:
+                (str)
+                Key that is never evicted, e.g. the one of the current run.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+            )
+            params_path = os.path.join(entry, "params.json")
+            last_used = os.path.getmtime(params_path) if os.path.isfile(params_path) else 0
+            entries.append((last_used, key, size))
+            total += size
+
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key))
+            total -= size
+        self.total = total
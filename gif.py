@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    GIF writer for sequences of weapon-index frames sharing one palette.
+
+All frames of a run use the palette produced by discretize(), so it is
+written once as the global color table. Every frame after the first only
+contains the rectangle that changed since the previous frame, unchanged
+pixels inside of it are transparent. Frames are compressed by the LZW
+encoder of PIL on a background thread, so the compression overlaps with the
+computation of the next frame.
+"""
+import io
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+def image_data(indices):
+    """The LZW compressed image data block of a frame, by the C encoder of PIL.
+
+        indices:
+            (numpy.ndarray)
+            Color indices, indexed [y, x].
+
+        RETURNS
+        (bytes) LZW minimum code size, data sub-blocks and block terminator,
+        to be written after an image descriptor.
+    """
+    img = Image.frombytes("P", (indices.shape[1], indices.shape[0]), np.ascontiguousarray(indices).tobytes())
+    img.putpalette(list(range(256)) * 3)
+    out = io.BytesIO()
+    # no palette optimization and no interlacing, the indices are written
+    # as they are, row by row
+    img.save(out, "GIF", optimize=False, interlace=False)
+    data = out.getvalue()
+
+    # skip header, logical screen descriptor and global color table
+    flags = data[10]
+    position = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+    # skip extensions
+    while data[position] == 0x21:
+        position += 2
+        while data[position]:
+            position += data[position] + 1
+        position += 1
+    # skip the image descriptor and its local color table
+    flags = data[position + 9]
+    position += 10 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+    # everything up to the trailer
+    return data[position:-1]
+
+
+class GifWriter():
+    """Append weapon-index frames to an animated GIF, one frame at a time."""
+
+    def __init__(self, path, size, palette, delay=4, loop=0, background=True):
+        """Open the GIF and write header and global color table.
+
+            path:
+                (str)
+                Where to write the GIF.
+            size:
+                (pair(int,int))
+                (WIDTH, HEIGHT) of every frame.
+            palette:
+                (list(int))
+                Flat [r, g, b, r, g, b, ...] list of the weapon colors.
+
+            OPTIONALS
+            delay:
+                (int)
+                Display time of each frame in 1/100 s.
+            loop:
+                (int)
+                Number of loops, 0 loops forever.
+            background:
+                (bool)
+                Whether or not to compress on a background thread. At most
+                two frames are waiting, add_frame() blocks beyond that.
+        """
+        self.size = size
+        self.delay = delay
+        self.previous = None
+        # (frame header, future of the compressed data), in frame order
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=1) if background else None
+
+        colors = len(palette) // 3
+        # an unused index marks unchanged pixels, if the palette has room
+        self.transparent = colors if colors < 256 else None
+        table_bits = max(1, int(np.ceil(np.log2(colors + (self.transparent is not None)))))
+
+        color_table = bytes(palette[:colors * 3])
+        color_table += b"\x00" * (3 * (1 << table_bits) - len(color_table))
+
+        self.file = open(path, "wb")
+        self.file.write(b"GIF89a")
+        self.file.write(struct.pack(
+            "<HHBBB",
+            size[0], size[1],
+            # global color table, 8 bit color resolution, table size
+            0x80 | 0x70 | (table_bits - 1),
+            0, 0
+        ))
+        self.file.write(color_table)
+        # NETSCAPE2.0 application extension for looping
+        self.file.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+
+    def add_frame(self, indices):
+        """Append a frame.
+
+            indices:
+                (numpy.ndarray)
+                Weapon indices of the frame, indexed [y, x].
+        """
+        indices = np.asarray(indices, dtype=np.uint8)
+        if self.previous is None:
+            x0, y0 = 0, 0
+            sub = indices
+        else:
+            changed = indices != self.previous
+            changed_rows = np.flatnonzero(changed.any(axis=1))
+            if len(changed_rows) == 0:
+                # nothing changed, repeat with a single pixel
+                x0, y0 = 0, 0
+                sub = indices[:1, :1]
+                if self.transparent is not None:
+                    sub = np.full((1, 1), self.transparent, dtype=np.uint8)
+            else:
+                changed_cols = np.flatnonzero(changed.any(axis=0))
+                y0, y1 = changed_rows[0], changed_rows[-1] + 1
+                x0, x1 = changed_cols[0], changed_cols[-1] + 1
+                sub = indices[y0:y1, x0:x1]
+                if self.transparent is not None:
+                    sub = np.where(changed[y0:y1, x0:x1], sub, self.transparent).astype(np.uint8)
+        self.previous = indices.copy()
+        self._write_image(int(x0), int(y0), sub)
+
+    def _write_image(self, x0, y0, sub):
+        # graphic control extension: keep the previous frame underneath
+        flags = (1 << 2) | (self.transparent is not None)
+        header = b"\x21\xF9\x04" + struct.pack(
+            "<BHBB",
+            flags, self.delay,
+            self.transparent or 0,
+            0
+        )
+        # image descriptor without local color table
+        header += b"\x2C" + struct.pack(
+            "<HHHHB",
+            x0, y0, sub.shape[1], sub.shape[0], 0
+        )
+        if self.pool is None:
+            self.file.write(header + image_data(sub))
+            return
+        self.pending.append((header, self.pool.submit(image_data, np.array(sub))))
+        # write finished frames, wait only if too many are outstanding
+        while self.pending and (len(self.pending) > 2 or self.pending[0][1].done()):
+            header, future = self.pending.popleft()
+            self.file.write(header + future.result())
+
+    def close(self):
+        """Write the outstanding frames and the trailer, close the file."""
+        while self.pending:
+            header, future = self.pending.popleft()
+            self.file.write(header + future.result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.file.write(b"\x3B")
+        self.file.close()
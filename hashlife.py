@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    HashLife engine for the synchronous rps rule on a wrapping grid.
+
+The grid is represented as a hash-consed quadtree: every distinct block is
+stored once and referenced by an integer id. For every block the future of
+its centre is memoized, so repeating textures are only ever computed once
+and 2**k generations can be skipped in a single step.
+
+Blocks at the bottom of the tree (leaves) are small squares of weapon
+indices, the futures of two-leaf-wide blocks are computed with the
+vectorized kernel of rps.py.
+
+The wrapping (toroidal) grid is unrolled into a periodic plane around it,
+which is exact as long as information cannot travel further than one block
+per generation - true for the 8-neighbourhood.
+"""
+import numpy as np
+
+import rps
+
+
+class _CapReached(Exception):
+    """Raised when the stored blocks and futures reach max_nodes during a jump."""
+
+
+class HashLife():
+    """Memoized quadtree engine for one set of rule parameters."""
+
+    def __init__(
+        self,
+        number_of_weapons,
+        weapon_range,
+        loss_threshold,
+        nh_seed="01010101",
+        nh_order="01234567",
+        leaf_level=3,
+        max_nodes=1 << 20,
+    ):
+        """Set up an empty engine.
+
+            See rps.generate_images() for the rule parameters. The loss
+            threshold has to be fixed and both borders have to wrap.
+
+            OPTIONALS
+            leaf_level:
+                (int)
+                Leaves are squares of 2**leaf_level cells.
+            max_nodes:
+                (int)
+                Memory cap on the stored blocks plus futures. A jump that
+                reaches it drops everything and is repeated as two jumps of
+                half the size, down to single generations computed without
+                the tree.
+        """
+        self.lose = rps.lose_table(number_of_weapons, weapon_range)
+        self.loss_threshold = loss_threshold
+        self.nh_seed = nh_seed
+        self.nh_order = nh_order
+        self.leaf_level = leaf_level
+        self.leaf_size = 1 << leaf_level
+        self.max_nodes = max_nodes
+        self.clear()
+
+    def clear(self):
+        """Drop all stored blocks and futures."""
+        # id -> leaf bytes or (nw, ne, sw, se) ids
+        self._nodes = []
+        # leaf bytes or (nw, ne, sw, se) ids -> id
+        self._ids = {}
+        # (id, j) -> id of the centre advanced 2**j generations
+        self._results = {}
+
+    # NODES =========================================================
+    def _check_cap(self):
+        if len(self._nodes) + len(self._results) >= self.max_nodes:
+            raise _CapReached()
+
+    def _intern(self, key):
+        node = self._ids.get(key)
+        if node is None:
+            self._check_cap()
+            node = len(self._nodes)
+            self._nodes.append(key)
+            self._ids[key] = node
+        return node
+
+    def _leaf(self, cells):
+        return self._intern(np.ascontiguousarray(cells, dtype=np.uint8).tobytes())
+
+    def _quad(self, nw, ne, sw, se):
+        return self._intern((nw, ne, sw, se))
+
+    def _array(self, node, level):
+        """The cells of a node as array."""
+        key = self._nodes[node]
+        if level == self.leaf_level:
+            return np.frombuffer(key, dtype=np.uint8).reshape(self.leaf_size, self.leaf_size)
+        nw, ne, sw, se = (self._array(child, level - 1) for child in key)
+        return np.block([[nw, ne], [sw, se]])
+
+    def _centre(self, node, level):
+        """The centre half of a node, not advanced."""
+        if level == self.leaf_level + 1:
+            quarter = self.leaf_size // 2
+            cells = self._array(node, level)
+            return self._leaf(cells[quarter:-quarter, quarter:-quarter])
+        nw, ne, sw, se = (self._nodes[child] for child in self._nodes[node])
+        return self._quad(nw[3], ne[2], sw[1], se[0])
+
+    # EVOLUTION =====================================================
+    def _result(self, node, level, j):
+        """The centre half of a node advanced 2**j generations (j <= level - 2)."""
+        memo = self._results.get((node, j))
+        if memo is not None:
+            return memo
+
+        if level == self.leaf_level + 1:
+            # small enough for the vectorized kernel, the outer quarter
+            # absorbs the cells computed with missing neighbours
+            cells = self._array(node, level)
+            indices = np.arange(cells.shape[0])
+            for _ in range(1 << j):
+                cells = rps.defend_cells(
+                    cells, indices, indices,
+                    self.lose, self.loss_threshold,
+                    overlap_x=False, overlap_y=False,
+                    nh_seed=self.nh_seed, nh_order=self.nh_order,
+                )
+            quarter = self.leaf_size // 2
+            result = self._leaf(cells[quarter:-quarter, quarter:-quarter])
+        else:
+            nw, ne, sw, se = self._nodes[node]
+            nw_, ne_, sw_, se_ = (self._nodes[child] for child in (nw, ne, sw, se))
+            # nine overlapping sub-nodes, one level below
+            sub = [
+                nw,
+                self._quad(nw_[1], ne_[0], nw_[3], ne_[2]),
+                ne,
+                self._quad(nw_[2], nw_[3], sw_[0], sw_[1]),
+                self._quad(nw_[3], ne_[2], sw_[1], se_[0]),
+                self._quad(ne_[2], ne_[3], se_[0], se_[1]),
+                sw,
+                self._quad(sw_[1], se_[0], sw_[3], se_[2]),
+                se,
+            ]
+            if j == level - 2:
+                # two half steps
+                r = [self._result(s, level - 1, j - 1) for s in sub]
+                step_j = j - 1
+            else:
+                # the whole step happens below
+                r = [self._centre(s, level - 1) for s in sub]
+                step_j = j
+            result = self._quad(
+                self._result(self._quad(r[0], r[1], r[3], r[4]), level - 1, step_j),
+                self._result(self._quad(r[1], r[2], r[4], r[5]), level - 1, step_j),
+                self._result(self._quad(r[3], r[4], r[6], r[7]), level - 1, step_j),
+                self._result(self._quad(r[4], r[5], r[7], r[8]), level - 1, step_j),
+            )
+
+        self._check_cap()
+        self._results[(node, j)] = result
+        return result
+
+    # TORUS =========================================================
+    def _build(self, grid, level, x0, y0, memo):
+        """The node covering the periodic plane of `grid` from (x0, y0)."""
+        y_len, x_len = grid.shape
+        key = (level, x0 % x_len, y0 % y_len)
+        node = memo.get(key)
+        if node is not None:
+            return node
+        if level == self.leaf_level:
+            offsets = np.arange(self.leaf_size)
+            node = self._leaf(grid[np.ix_((y0 + offsets) % y_len, (x0 + offsets) % x_len)])
+        else:
+            half = 1 << (level - 1)
+            node = self._quad(
+                self._build(grid, level - 1, x0, y0, memo),
+                self._build(grid, level - 1, x0 + half, y0, memo),
+                self._build(grid, level - 1, x0, y0 + half, memo),
+                self._build(grid, level - 1, x0 + half, y0 + half, memo),
+            )
+        memo[key] = node
+        return node
+
+    def _extract(self, node, level, x0, y0, out):
+        """Write the part of a node at (x0, y0) that overlaps `out`."""
+        size = 1 << level
+        y_len, x_len = out.shape
+        if x0 >= x_len or y0 >= y_len:
+            return
+        if level == self.leaf_level:
+            cells = self._array(node, level)
+            out[y0:y0 + size, x0:x0 + size] = cells[:y_len - y0, :x_len - x0]
+            return
+        half = size // 2
+        nw, ne, sw, se = self._nodes[node]
+        self._extract(nw, level - 1, x0, y0, out)
+        self._extract(ne, level - 1, x0 + half, y0, out)
+        self._extract(sw, level - 1, x0, y0 + half, out)
+        self._extract(se, level - 1, x0 + half, y0 + half, out)
+
+    def jump(self, grid, j):
+        """Advance a wrapping grid by 2**j generations.
+
+            grid:
+                (numpy.ndarray)
+                Weapon indices, indexed [y, x].
+
+            RETURNS
+            (numpy.ndarray) The weapon indices 2**j generations later.
+        """
+        try:
+            return self._jump(grid, j)
+        except _CapReached:
+            # too little repetition for the cap, retry in smaller jumps
+            self.clear()
+        if j > 0:
+            return self.jump(self.jump(grid, j - 1), j - 1)
+        out = np.empty_like(grid)
+        rps.step(
+            grid, out,
+            self.lose, self.loss_threshold,
+            nh_seed=self.nh_seed, nh_order=self.nh_order,
+        )
+        return out
+
+    def _jump(self, grid, j):
+        y_len, x_len = grid.shape
+        # the centre half has to cover the grid and the step has to fit
+        level = max(
+            self.leaf_level + 1,
+            j + 2,
+            int(np.ceil(np.log2(max(x_len, y_len)))) + 1,
+        )
+        quarter = 1 << (level - 2)
+        root = self._build(grid, level, -quarter, -quarter, {})
+        # the result starts at the origin of the grid
+        out = np.empty_like(grid)
+        self._extract(self._result(root, level, j), level - 1, 0, 0, out)
+        return out
+
+    def advance(self, grid, generations):
+        """Advance a wrapping grid by any number of generations, in power of 2 jumps."""
+        j = 0
+        while generations:
+            if generations & 1:
+                grid = self.jump(grid, j)
+            generations >>= 1
+            j += 1
+        return grid
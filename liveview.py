@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Live view of a running simulation through named shared memory.
+
+The simulation publishes every iteration into one shared memory segment:
+a fixed header (iteration, size, palette, metrics) followed by the weapon
+indices. Writes are guarded by a sequence lock: the counter is odd while a
+write is in progress, so readers copy the segment and retry if the counter
+was odd or changed in between. The simulation never waits for readers.
+
+    $ python3 liveview.py NAME --snapshot now.png
+    $ python3 liveview.py NAME --serve 8000
+"""
+import os
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b"IMCA"
+VERSION = 1
+MAX_COLORS = 256
+
+HEADER = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u4"),
+    # odd while the publisher is writing
+    ("seq", "<u8"),
+    ("iteration", "<i8"),
+    ("height", "<u4"),
+    ("width", "<u4"),
+    ("colors", "<u4"),
+    # process id of the publisher
+    ("pid", "<u4"),
+    # time.time() of the publication
+    ("time", "<f8"),
+    # cells that changed since the previous publication
+    ("changed", "<u8"),
+    ("palette", "u1", (3 * MAX_COLORS,)),
+    ("population", "<u8", (MAX_COLORS,)),
+])
+
+
+def _views(shm):
+    header = np.ndarray((), dtype=HEADER, buffer=shm.buf)
+    height, width = int(header["height"]), int(header["width"])
+    grid = np.ndarray((height, width), dtype=np.uint8, buffer=shm.buf, offset=HEADER.itemsize)
+    return header, grid
+
+
+def _pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to another user
+        return True
+    return True
+
+
+class LivePublisher():
+    """Writer side, owned by the simulation."""
+
+    def __init__(self, name, shape, palette):
+        """Create the segment.
+
+            A segment of the same name is only replaced if it was left
+            behind by a publisher that is no longer running, otherwise
+            FileExistsError is raised.
+
+            name:
+                (str)
+                Name of the shared memory segment.
+            shape:
+                (pair(int,int))
+                (HEIGHT, WIDTH) of the grid.
+            palette:
+                (list(int))
+                Flat [r, g, b, ...] palette of the weapons.
+        """
+        size = HEADER.itemsize + shape[0] * shape[1]
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._remove_stale(name)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+        header["magic"] = MAGIC
+        header["version"] = VERSION
+        header["seq"] = 0
+        header["iteration"] = -1
+        header["height"], header["width"] = shape
+        header["colors"] = len(palette) // 3
+        header["pid"] = os.getpid()
+        header["palette"][:len(palette)] = palette
+        del header
+        self.header, self.grid = _views(self.shm)
+
+    @staticmethod
+    def _remove_stale(name):
+        existing = shared_memory.SharedMemory(name=name)
+        owner = None
+        if existing.size >= HEADER.itemsize:
+            header = np.ndarray((), dtype=HEADER, buffer=existing.buf)
+            if bytes(header["magic"]) == MAGIC:
+                owner = int(header["pid"])
+            del header
+        if owner is None or _pid_alive(owner):
+            # attaching registered the segment, which would remove it on exit
+            resource_tracker.unregister(existing._name, "shared_memory")
+            existing.close()
+            if owner is None:
+                raise FileExistsError("Shared memory '{}' exists and is not an imca live view, choose another name.".format(name))
+            raise FileExistsError("Live view '{}' is published by the running process {}, choose another name.".format(name, owner))
+        # left behind by a crashed run
+        existing.close()
+        existing.unlink()
+
+    def set_palette(self, palette):
+        """Replace the palette, e.g. of a continued run."""
+        header = self.header
+        header["seq"] += 1
+        header["colors"] = len(palette) // 3
+        header["palette"][:] = 0
+        header["palette"][:len(palette)] = palette
+        header["seq"] += 1
+
+    def publish(self, iteration, grid):
+        """Copy the grid of `iteration` into the segment."""
+        header = self.header
+        header["seq"] += 1
+        changed = np.count_nonzero(self.grid != grid)
+        self.grid[...] = grid
+        header["iteration"] = iteration
+        header["time"] = time.time()
+        header["changed"] = changed
+        header["population"][:header["colors"]] = np.bincount(
+            grid.ravel(), minlength=int(header["colors"])
+        )[:int(header["colors"])]
+        header["seq"] += 1
+
+    def close(self):
+        """Remove the segment."""
+        del self.header, self.grid
+        self.shm.close()
+        self.shm.unlink()
+
+
+class LiveReader():
+    """Reader side, attaches to the segment of a running simulation."""
+
+    def __init__(self, name):
+        if sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # before Python 3.13 every attached process registers the
+            # segment and removes it on exit
+            from multiprocessing import resource_tracker
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.header, self.grid = _views(self.shm)
+        if bytes(self.header["magic"]) != MAGIC or int(self.header["version"]) != VERSION:
+            raise ValueError("'{}' is not an imca live view.".format(name))
+
+    def snapshot(self, timeout=1.0):
+        """A consistent copy of the latest publication.
+
+            RETURNS
+            (dict) iteration, time, changed, population, palette and grid,
+            None if the segment stayed busy for `timeout` seconds or
+            nothing was published yet.
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            seq = int(self.header["seq"])
+            if seq % 2 == 0:
+                header = self.header.copy()
+                grid = self.grid.copy()
+                if int(self.header["seq"]) == seq:
+                    if header["iteration"] < 0:
+                        return None
+                    colors = int(header["colors"])
+                    return {
+                        "iteration": int(header["iteration"]),
+                        "time": float(header["time"]),
+                        "changed": int(header["changed"]),
+                        "population": header["population"][:colors].tolist(),
+                        "palette": header["palette"][:3 * colors].tolist(),
+                        "grid": grid,
+                    }
+            time.sleep(0.001)
+        return None
+
+    def close(self):
+        del self.header, self.grid
+        self.shm.close()
+
+
+def snapshot_image(state, max_size=None):
+    """The grid of a snapshot as palette image, halved until it fits max_size."""
+    from pyramid import mode_pool
+    grid = state["grid"]
+    while max_size is not None and max(grid.shape) > max_size:
+        grid = mode_pool(grid)
+    img = Image.frombytes("P", (grid.shape[1], grid.shape[0]), np.ascontiguousarray(grid).tobytes())
+    img.putpalette(state["palette"])
+    return img
+
+
+def serve(reader, port, max_size=512):
+    """Serve the latest thumbnail (/frame.png) and metrics (/state.json) on localhost."""
+    import io
+    import json
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    page = (
+        "<html><body style='background:#000;color:#fff;font-family:monospace'>"
+        "<img id='f' style='image-rendering:pixelated;width:{size}px'><pre id='s'></pre><script>"
+        "setInterval(function(){{"
+        "document.getElementById('f').src='/frame.png?'+Date.now();"
+        "fetch('/state.json').then(r=>r.text()).then(t=>document.getElementById('s').textContent=t);"
+        "}},1000);</script></body></html>"
+    ).format(size=max_size).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/":
+                self._send(page, "text/html")
+                return
+            state = reader.snapshot()
+            if state is None:
+                self.send_error(503, "No publication yet")
+            elif path == "/frame.png":
+                out = io.BytesIO()
+                snapshot_image(state, max_size).save(out, "PNG")
+                self._send(out.getvalue(), "image/png")
+            elif path == "/state.json":
+                state = {key: value for key, value in state.items() if key not in ["grid", "palette"]}
+                self._send(json.dumps(state).encode(), "application/json")
+            else:
+                self.send_error(404)
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    print("Serving on http://localhost:{}/".format(port))
+    HTTPServer(("localhost", port), Handler).serve_forever()
+
+
+# ENTRY =============================================================
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "name",
+        help="Name of the live view, as given to rps.py --live."
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="PNG_PATH",
+        dest="snapshot",
+        help="Write the latest frame to PNG_PATH.",
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="PORT",
+        dest="port",
+        help="Serve the latest frame and metrics on http://localhost:PORT/.",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--max-size",
+        metavar="SIZE",
+        dest="max_size",
+        help="Maximum width and height of served frames and snapshots. (None->full size for snapshots, 512 when serving)",
+        default=None,
+        type=int
+    )
+    args = parser.parse_args()
+
+    reader = LiveReader(args.name)
+    if args.port is not None:
+        serve(reader, args.port, args.max_size or 512)
+    else:
+        state = reader.snapshot()
+        if state is None:
+            print("Nothing published yet.")
+            sys.exit(1)
+        print("Iteration {}, {} changed cells, population {}".format(
+            state["iteration"], state["changed"], state["population"]
+        ))
+        if args.snapshot is not None:
+            snapshot_image(state, args.max_size).save(args.snapshot, "PNG")
+            print("Wrote snapshot to " + args.snapshot)
+    reader.close()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Montage of several runs side by side, streamed into a gif or video.
+
+Every run is a directory of numbered frames, either the output directory of
+rps.py or an entry of its frame cache. The runs are laid out in a grid of
+cells, each optionally labeled below. The montage is composed in index space:
+the palettes of all runs (and the label colors) are joined into one palette,
+so every run keeps its own colors. Runs shorter than the longest one hold
+their last frame.
+"""
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from gif import GifWriter
+from rps import frame_indices, numbered_files
+
+# height of the label band below each cell
+LABEL_HEIGHT = 14
+
+
+def run_palette(first_frame):
+    """The flat [r, g, b, ...] palette of a run from its first frame.
+
+        Weapons never appear during a run, so the first frame holds the
+        largest weapon index.
+    """
+    colors = int(np.array(first_frame).max()) + 1
+    palette = (first_frame.getpalette() or [])[:colors * 3]
+    return palette + [0] * (colors * 3 - len(palette))
+
+
+def parse_palette(text):
+    """Flat [r, g, b, ...] palette of comma separated hex colors, e.g. "ff0000,00ff00"."""
+    return [
+        int(color.strip().lstrip("#")[i:i + 2], 16)
+        for color in text.split(",")
+        for i in (0, 2, 4)
+    ]
+
+
+# WORKERS ===========================================================
+# set once per worker process by _init_worker()
+_background = None
+_cells = None
+
+
+def _init_worker(background, cells):
+    global _background, _cells
+    _background = background
+    _cells = []
+    for x0, y0, offset, saved_palette in cells:
+        ref = Image.new("P", (1, 1))
+        ref.putpalette(saved_palette)
+        _cells.append((x0, y0, offset, saved_palette, ref))
+
+
+def _compose(paths):
+    """The montage indices of one frame, given the frame path of every run."""
+    canvas = _background.copy()
+    for path, (x0, y0, offset, saved_palette, ref) in zip(paths, _cells):
+        frame = Image.open(path)
+        if frame.mode == "P" and (frame.getpalette() or [])[:len(saved_palette)] == saved_palette:
+            frame = np.array(frame)
+        else:
+            # frames saved with another palette are mapped onto the first one
+            frame = frame_indices(frame, ref)
+        # offsets beyond 255 need the wider canvas type
+        canvas[y0:y0 + frame.shape[0], x0:x0 + frame.shape[1]] = frame.astype(canvas.dtype) + offset
+    return canvas
+
+
+# MONTAGE ===========================================================
+class FfmpegWriter():
+    """Pipe RGB frames into an ffmpeg process."""
+
+    def __init__(self, path, size, palette, fps=25):
+        self.palette = np.array(palette, dtype=np.uint8).reshape(-1, 3)
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgb24",
+                "-s", "{}x{}".format(size[0], size[1]),
+                "-r", str(fps),
+                "-i", "-",
+                "-pix_fmt", "yuv420p",
+                path
+            ],
+            stdin=subprocess.PIPE
+        )
+
+    def add_frame(self, indices):
+        self.process.stdin.write(self.palette[indices].tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def generate_montage(
+    run_dirs,
+    out_path,
+    columns=None,
+    labels=None,
+    palettes=None,
+    workers=None,
+    fps=25,
+):
+    """Compose the frames of several runs into one gif or video.
+
+        run_dirs:
+            (list(str))
+            Directories of numbered frames.
+        out_path:
+            (str)
+            *.gif is written natively, everything else is encoded by ffmpeg.
+
+        OPTIONALS
+        columns:
+            (int)
+            Number of cells per row. (None->square layout)
+        labels:
+            (list(str))
+            Text below each cell. (None->no labels)
+        palettes:
+            (list(list(int)))
+            Flat [r, g, b, ...] palette of each run, None entries keep the
+            palette the run was saved with.
+        workers:
+            (int)
+            Number of processes composing frames. At most two frames per
+            process are in flight.
+        fps:
+            (int)
+            Frame rate of videos, gifs use 1/fps s per frame.
+    """
+    print("Running imca: montage\n")
+    runs = [numbered_files(run_dir) for run_dir in run_dirs]
+    for run_dir, files in zip(run_dirs, runs):
+        if not files:
+            raise ValueError("No numbered frames in " + run_dir)
+    if palettes is None:
+        palettes = [None] * len(runs)
+    frame_count = max(len(files) for files in runs)
+
+    # joint palette: the weapons of every run, then background and text
+    palette = []
+    cells = []
+    first_frames = [Image.open(files[0]) for files in runs]
+    columns = columns or int(np.ceil(np.sqrt(len(runs))))
+    cell_width = max(img.width for img in first_frames)
+    cell_height = max(img.height for img in first_frames) + (LABEL_HEIGHT if labels else 0)
+    for number, (img, run_palette_) in enumerate(zip(first_frames, palettes)):
+        saved = run_palette(img)
+        own = saved
+        if run_palette_ is not None:
+            if len(run_palette_) < len(saved):
+                raise ValueError("Palette of run {} needs {} colors.".format(number, len(saved) // 3))
+            own = run_palette_[:len(saved)]
+        cells.append((
+            (number % columns) * cell_width,
+            (number // columns) * cell_height,
+            len(palette) // 3,
+            saved
+        ))
+        palette += own
+    background = len(palette) // 3
+    text = background + 1
+    palette += [0, 0, 0, 255, 255, 255]
+    print("> Runs:\n  : {}".format(len(runs)))
+    print("> Frames:\n  : {}".format(frame_count))
+    print("> Colors:\n  : {}".format(len(palette) // 3))
+
+    rows = -(-len(runs) // columns)
+    # even dimensions for yuv420p videos
+    size = (columns * cell_width + (columns * cell_width) % 2, rows * cell_height + (rows * cell_height) % 2)
+    background_indices = np.full(
+        (size[1], size[0]),
+        background,
+        dtype=np.uint8 if len(palette) <= 3 * 256 else np.uint16
+    )
+    if labels:
+        label_mask = Image.new("1", size)
+        draw = ImageDraw.Draw(label_mask)
+        for (x0, y0, _, _), label in zip(cells, labels):
+            draw.text((x0 + 2, y0 + cell_height - LABEL_HEIGHT + 1), label, fill=1)
+        background_indices[np.array(label_mask)] = text
+
+    if out_path.lower().endswith(".gif"):
+        if len(palette) > 3 * 256:
+            raise ValueError("A gif holds at most 256 colors, the runs need {}.".format(len(palette) // 3))
+        writer = GifWriter(out_path, size, palette, delay=max(1, round(100 / fps)))
+    else:
+        writer = FfmpegWriter(out_path, size, palette, fps=fps)
+
+    pending = deque()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(background_indices, cells)
+    ) as pool:
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        for number in range(frame_count):
+            # shorter runs hold their last frame
+            paths = [files[min(number, len(files) - 1)] for files in runs]
+            pending.append(pool.submit(_compose, paths))
+            # frames are written in order, at most max_pending are held
+            if len(pending) >= max_pending:
+                writer.add_frame(pending.popleft().result())
+        while pending:
+            writer.add_frame(pending.popleft().result())
+    writer.close()
+    print("Wrote montage to " + out_path)
+
+
+# ENTRY =============================================================
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "run_dirs",
+        nargs="+",
+        help="Directories of numbered frames: rps.py output directories or cache entries."
+    )
+    parser.add_argument(
+        "--out",
+        metavar="OUT_PATH",
+        dest="out_path",
+        help="Output file, *.gif is written natively, other extensions (e.g. *.mp4) need ffmpeg.",
+        default="montage.gif",
+        type=str
+    )
+    parser.add_argument(
+        "--columns",
+        metavar="N",
+        dest="columns",
+        help="Number of runs per row. (None->square layout)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--labels",
+        metavar="LABEL",
+        dest="labels",
+        nargs="*",
+        help="Label each run, without values by the name of its directory.",
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        "--palette",
+        metavar="COLORS",
+        dest="palettes",
+        action="append",
+        help='Colors of the next run as comma separated hex values, e.g. "ff0000,00ff00,0000ff". "-" keeps the saved colors. Repeat once per run.',
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        dest="workers",
+        help="Number of composing processes. (None->number of cores)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--fps",
+        metavar="FPS",
+        dest="fps",
+        help="Frames per second.",
+        default=25,
+        type=int
+    )
+    args = parser.parse_args()
+
+    print(args)
+
+    labels = args.labels
+    if labels is not None and len(labels) == 0:
+        labels = [os.path.basename(os.path.normpath(run_dir)) for run_dir in args.run_dirs]
+    palettes = None
+    if args.palettes is not None:
+        palettes = [None if p == "-" else parse_palette(p) for p in args.palettes]
+        palettes += [None] * (len(args.run_dirs) - len(palettes))
+
+    generate_montage(
+        args.run_dirs,
+        args.out_path,
+        columns=args.columns,
+        labels=labels,
+        palettes=palettes,
+        workers=args.workers,
+        fps=args.fps,
+    )
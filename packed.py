@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Bit-packed weapon indices for small numbers of weapons.
+
+Cells are packed along x, the first cell of a byte in its lowest bits:
+four cells per byte for up to 4 weapons, two cells per byte for up to 16.
+"""
+import numpy as np
+
+
+def bits_per_cell(number_of_weapons):
+    """Bits needed per cell, None if the weapons do not fit into 4 bits."""
+    if number_of_weapons <= 4:
+        return 2
+    if number_of_weapons <= 16:
+        return 4
+    return None
+
+
+def packed_width(width, bits):
+    """Number of bytes per packed row of `width` cells."""
+    cells_per_byte = 8 // bits
+    return -(-width // cells_per_byte)
+
+
+def pack(grid, bits):
+    """Pack weapon indices [y, x] into rows of bytes.
+
+        grid:
+            (numpy.ndarray)
+            Weapon indices, each smaller than 2**bits.
+        bits:
+            (int)
+            2 or 4, see bits_per_cell().
+
+        RETURNS
+        (numpy.ndarray) uint8 array of shape (height, packed_width()).
+    """
+    cells_per_byte = 8 // bits
+    height, width = grid.shape
+    padded = np.zeros((height, packed_width(width, bits) * cells_per_byte), dtype=np.uint8)
+    padded[:, :width] = grid
+    shifts = np.arange(cells_per_byte, dtype=np.uint8) * bits
+    cells = padded.reshape(height, -1, cells_per_byte) << shifts
+    return np.bitwise_or.reduce(cells, axis=2)
+
+
+def unpack(packed, width, bits):
+    """Inverse of pack(), RETURNS the weapon indices of the first `width` cells of each row."""
+    cells_per_byte = 8 // bits
+    shifts = np.arange(cells_per_byte, dtype=np.uint8) * bits
+    cells = (packed[:, :, None] >> shifts) & ((1 << bits) - 1)
+    return cells.reshape(packed.shape[0], -1)[:, :width]
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Tiled multi-resolution pyramids of weapon-index frames.
+
+Level 0 is the full frame, every further level halves both dimensions by
+taking the most frequent weapon of each 2x2 block, so all levels only
+contain the colors of the palette. Every level is cut into square tiles:
+    <pyramid>/meta.json
+    <pyramid>/<level>/<tile_y>_<tile_x>.png
+"""
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+
+def mode_pool(grid):
+    """Halve a grid by the most frequent value of each 2x2 block.
+
+        Ties are resolved in the order top-left, top-right, bottom-left,
+        bottom-right. Odd dimensions repeat their last row/column.
+    """
+    pad_y = grid.shape[0] % 2
+    pad_x = grid.shape[1] % 2
+    if pad_y or pad_x:
+        grid = np.pad(grid, ((0, pad_y), (0, pad_x)), mode="edge")
+    block = [grid[0::2, 0::2], grid[0::2, 1::2], grid[1::2, 0::2], grid[1::2, 1::2]]
+    counts = np.stack([
+        sum((a == b).astype(np.uint8) for b in block)
+        for a in block
+    ])
+    return np.choose(np.argmax(counts, axis=0), block)
+
+
+def _save_tile(cells, palette, file_name):
+    tile = Image.frombytes("P", (cells.shape[1], cells.shape[0]), np.ascontiguousarray(cells).tobytes())
+    tile.putpalette(palette)
+    tile.save(file_name, "PNG")
+
+
+def write_pyramid(grid, palette, out_dir, tile_size=256):
+    """Write the pyramid of one frame.
+
+        grid:
+            (numpy.ndarray)
+            Weapon indices, indexed [y, x].
+        palette:
+            (list(int))
+            Flat [r, g, b, ...] palette of the weapons.
+        out_dir:
+            (str)
+            Directory of the pyramid, created if missing.
+
+        OPTIONALS
+        tile_size:
+            (int)
+            Width and height of the tiles.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    sizes = []
+    while True:
+        level_dir = os.path.join(out_dir, str(len(sizes)))
+        os.makedirs(level_dir, exist_ok=True)
+        for tile_y in range(0, grid.shape[0], tile_size):
+            for tile_x in range(0, grid.shape[1], tile_size):
+                _save_tile(
+                    grid[tile_y:tile_y + tile_size, tile_x:tile_x + tile_size],
+                    palette,
+                    os.path.join(level_dir, "{}_{}.png".format(tile_y // tile_size, tile_x // tile_size))
+                )
+        sizes.append([int(grid.shape[1]), int(grid.shape[0])])
+        # the top level fits into a single tile
+        if max(grid.shape) <= tile_size:
+            break
+        grid = mode_pool(grid)
+
+    # written last, marks the pyramid as complete
+    with open(os.path.join(out_dir, "meta.json"), "w") as meta_file:
+        json.dump({"tile_size": tile_size, "sizes": sizes}, meta_file)
+
+
+def read_meta(pyramid_dir):
+    """The meta data of a pyramid: tile_size and the (width, height) of each level."""
+    with open(os.path.join(pyramid_dir, "meta.json")) as meta_file:
+        return json.load(meta_file)
+
+
+def read_region(pyramid_dir, level, box):
+    """Read part of one level, opening only the tiles overlapping it.
+
+        pyramid_dir:
+            (str)
+            Directory written by write_pyramid().
+        level:
+            (int)
+            0 is the full resolution.
+        box:
+            (tuple(int,int,int,int))
+            (LEFT, UPPER, RIGHT, LOWER) in pixels of that level.
+
+        RETURNS
+        (PIL.Image.Image) The region as palette image.
+    """
+    tile_size = read_meta(pyramid_dir)["tile_size"]
+    left, upper, right, lower = box
+    region = None
+    for tile_y in range(upper // tile_size, (lower - 1) // tile_size + 1):
+        for tile_x in range(left // tile_size, (right - 1) // tile_size + 1):
+            tile = Image.open(os.path.join(
+                pyramid_dir, str(level), "{}_{}.png".format(tile_y, tile_x)
+            ))
+            if region is None:
+                region = Image.new("P", (right - left, lower - upper))
+                region.putpalette(tile.getpalette())
+            region.paste(tile, (tile_x * tile_size - left, tile_y * tile_size - upper))
+    return region
+
+
+def thumbnail(pyramid_dir, max_size):
+    """The finest level fitting into max_size x max_size, as palette image."""
+    sizes = read_meta(pyramid_dir)["sizes"]
+    level = len(sizes) - 1
+    while level > 0 and max(sizes[level - 1]) <= max_size:
+        level -= 1
+    width, height = sizes[level]
+    return read_region(pyramid_dir, level, (0, 0, width, height))
+
+
+def _write_shared(name, shape, dtype, palette, out_dir, tile_size):
+    # the frame is read from the segment of PyramidSink.add()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        grid = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        write_pyramid(grid, palette, out_dir, tile_size)
+        del grid
+    finally:
+        shm.close()
+
+
+def pyramid_exists(pyramid_dir):
+    """Whether or not the pyramid was written completely."""
+    return os.path.isfile(os.path.join(pyramid_dir, "meta.json"))
+
+
+class PyramidSink():
+    """Write pyramids of selected frames on worker processes while the simulation runs."""
+
+    def __init__(self, out_dir, palette, every=1, tile_size=256, workers=1):
+        """Start the workers.
+
+            out_dir:
+                (str)
+                The pyramid of frame N is written to out_dir/N.
+            palette:
+                (list(int))
+                Flat [r, g, b, ...] palette of the weapons.
+
+            OPTIONALS
+            every:
+                (int)
+                Only every EVERY-th frame gets a pyramid.
+            tile_size:
+                (int)
+                See write_pyramid().
+            workers:
+                (int)
+                Number of worker processes. At most two frames per worker
+                are waiting, add() blocks beyond that. Frames are handed
+                over in shared memory instead of through the process pipe.
+        """
+        self.out_dir = out_dir
+        self.palette = palette
+        self.every = every
+        self.tile_size = tile_size
+        self.max_pending = 2 * workers
+        self.pending = deque()
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def add(self, number, grid):
+        """Queue the pyramid of frame `number` if it is selected."""
+        if number % self.every:
+            return
+        while len(self.pending) >= self.max_pending:
+            self._finish()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, grid.nbytes))
+        np.ndarray(grid.shape, dtype=grid.dtype, buffer=shm.buf)[...] = grid
+        self.pending.append((shm, self.pool.submit(
+            _write_shared,
+            shm.name,
+            grid.shape,
+            grid.dtype.str,
+            self.palette,
+            os.path.join(self.out_dir, str(number)),
+            self.tile_size
+        )))
+
+    def _finish(self):
+        # wait for the oldest pyramid, then free its frame
+        shm, future = self.pending.popleft()
+        try:
+            future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        """Wait for all pyramids to be written."""
+        try:
+            while self.pending:
+                self._finish()
+        finally:
+            self.pool.shutdown()
+
+
+# ENTRY =============================================================
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) not in [2, 3]:
+        print("Usage:   python3 pyramid.py <pyramid_dir> <png_path> [max_size]")
+        print("            <pyramid_dir> : path/to/pyramid  written by rps.py --pyramid-every.")
+        print("            <png_path>    : path/to/file.png to which the thumbnail is written.")
+        print("            [max_size]    : maximum width and height of the thumbnail (default 256).")
+        sys.exit()
+
+    thumbnail(args[0], int(args[2]) if len(args) == 3 else 256).save(args[1], "PNG")
+    print("Wrote thumbnail to " + args[1])
@@ -2,6 +2,13 @@
 # -*- coding: utf-8 -*-
 
 NUM_NEIGHBOURS = 8
+# bump whenever a change alters the frames produced for the same parameters
+ENGINE_VERSION = 1
+# (dx, dy) of each neighbour, same indexing as nh_seed / nh_order
+NEIGHBOUR_OFFSETS = [
+    (-1, -1), ( 0, -1), ( 1, -1), ( 1,  0),
+    ( 1,  1), ( 0,  1), (-1,  1), (-1,  0),
+]
 
 def defend(own_weapon, enemy_weapon, number_of_weapons, weapon_range):
     # survive same color
@@ -144,6 +151,266 @@ def defend_against_neighbours(
     return own_weapon
 
 
+def lose_table(number_of_weapons, weapon_range):
+    """Tabulate `defend` for every pair of weapons.
+
+        RETURNS
+        (numpy.ndarray)
+        Boolean table, True at [own_weapon, enemy_weapon] if own_weapon looses.
+    """
+    table = np.zeros((number_of_weapons, number_of_weapons), dtype=bool)
+    for own_weapon in range(number_of_weapons):
+        for enemy_weapon in range(number_of_weapons):
+            table[own_weapon, enemy_weapon] = not defend(
+                own_weapon=own_weapon,
+                enemy_weapon=enemy_weapon,
+                number_of_weapons=number_of_weapons,
+                weapon_range=weapon_range
+            )
+    return table
+
+
+def defend_cells(
+    src, rows, cols,
+    lose, loss_threshold,
+    overlap_x=True, overlap_y=True,
+    nh_seed="01010101", nh_order="01234567",
+):
+    """Vectorized `defend_against_neighbours` for a block of cells.
+
+        src:
+            (numpy.ndarray)
+            Weapon indices of the whole grid, indexed [y, x].
+        rows:
+            (numpy.ndarray)
+            Y-coordinates of the block.
+        cols:
+            (numpy.ndarray)
+            X-coordinates of the block.
+        lose:
+            (numpy.ndarray)
+            See lose_table().
+
+        See defend_against_neighbours() for the remaining arguments.
+
+        RETURNS
+        The new values for the block, shape (len(rows), len(cols)).
+    """
+    y_len, x_len = src.shape
+    own = src[np.ix_(rows, cols)]
+    new = own.copy()
+    losses = np.zeros(own.shape, dtype=np.uint8)
+    replaced = np.zeros(own.shape, dtype=bool)
+
+    for order_to_neighbour in nh_order:
+        neighbour = int(order_to_neighbour)
+        if not int(nh_seed[neighbour]):
+            continue
+        dx, dy = NEIGHBOUR_OFFSETS[neighbour]
+        ys = rows + dy
+        xs = cols + dx
+        enemy = src[np.ix_(ys % y_len, xs % x_len)]
+        lost = lose[own, enemy]
+        # neighbours beyond a non-wrapping border do not attack
+        if not overlap_y:
+            lost &= ((ys >= 0) & (ys < y_len))[:, None]
+        if not overlap_x:
+            lost &= ((xs >= 0) & (xs < x_len))[None, :]
+        losses += lost
+        # only the attacker reaching the threshold first takes the spot
+        hit = lost & ~replaced & (losses >= loss_threshold)
+        new[hit] = enemy[hit]
+        replaced |= hit
+
+    return new
+
+
+def run_bands(update_band, rows, pool=None, bands=1):
+    """Split `rows` into `bands` consecutive parts and call update_band on each.
+
+        update_band:
+            (callable)
+            Called with the rows of one band.
+        rows:
+            (numpy.ndarray)
+            The rows to split.
+
+        OPTIONALS
+        pool:
+            (concurrent.futures.Executor)
+            Runs the bands concurrently, None runs them one after another.
+        bands:
+            (int)
+            Number of bands.
+    """
+    row_bands = [band for band in np.array_split(rows, bands) if len(band)]
+    if pool is None:
+        for band in row_bands:
+            update_band(band)
+    else:
+        for future in [pool.submit(update_band, band) for band in row_bands]:
+            future.result()
+
+
+def step(
+    src, dst,
+    lose, loss_threshold,
+    overlap_x=True, overlap_y=True,
+    nh_seed="01010101", nh_order="01234567",
+    pool=None, bands=1,
+):
+    """Update every cell of `src` at once and write the result into `dst`.
+
+        src:
+            (numpy.ndarray)
+            Weapon indices of the previous iteration.
+        dst:
+            (numpy.ndarray)
+            Preallocated buffer of the same shape, receives the next iteration.
+
+        OPTIONALS
+        pool:
+            (concurrent.futures.Executor)
+            Runs the bands concurrently, None runs them one after another.
+        bands:
+            (int)
+            Number of horizontal bands the grid is split into.
+
+        See defend_cells() for the remaining arguments.
+    """
+    cols = np.arange(src.shape[1])
+
+    def update_band(rows):
+        dst[rows[0]:rows[-1] + 1] = defend_cells(
+            src, rows, cols,
+            lose, loss_threshold,
+            overlap_x=overlap_x, overlap_y=overlap_y,
+            nh_seed=nh_seed, nh_order=nh_order,
+        )
+
+    run_bands(update_band, np.arange(src.shape[0]), pool=pool, bands=bands)
+
+
+def step_packed(
+    src, dst, width, bits,
+    lose, loss_threshold,
+    overlap_x=True, overlap_y=True,
+    nh_seed="01010101", nh_order="01234567",
+    pool=None, bands=1,
+    tile_rows=64,
+):
+    """step() on bit-packed weapon indices (see packed.py).
+
+        The grid is processed in tiles of at most `tile_rows` rows, whatever
+        the number of bands. Each tile is unpacked together with the rows
+        bordering it, updated and packed into `dst` again, so the grid is
+        never unpacked as a whole.
+
+        width:
+            (int)
+            Number of cells per row.
+        bits:
+            (int)
+            Bits per cell.
+
+        OPTIONALS
+        tile_rows:
+            (int)
+            Maximum number of rows unpacked at once.
+
+        See step() for the remaining arguments.
+    """
+    y_len = src.shape[0]
+    cols = np.arange(width)
+
+    def update_band(rows):
+        y_start, y_end = rows[0], rows[-1] + 1
+        # rows bordering the band, unless beyond a non-wrapping border
+        above = [(y_start - 1) % y_len] if overlap_y or y_start > 0 else []
+        below = [y_end % y_len] if overlap_y or y_end < y_len else []
+        block = unpack(src[above + list(rows) + below], width, bits)
+        dst[y_start:y_end] = pack(defend_cells(
+            block, np.arange(len(above), len(above) + len(rows)), cols,
+            lose, loss_threshold,
+            overlap_x=overlap_x, overlap_y=False,
+            nh_seed=nh_seed, nh_order=nh_order,
+        ), bits)
+
+    tiles = -(-y_len // tile_rows)
+    run_bands(update_band, np.arange(y_len), pool=pool, bands=max(bands, tiles))
+
+
+def colour_classes(length, overlap):
+    """Split the coordinates of one axis into classes without adjacent members.
+
+        Alternating coordinates share a class. If the axis wraps and has an
+        odd length, the last coordinate would touch the first one and gets a
+        class of its own.
+
+        RETURNS
+        (list(numpy.ndarray)) Coordinates of each class.
+    """
+    coords = np.arange(length)
+    classes = [coords[0::2], coords[1::2]]
+    if overlap and length > 1 and length % 2:
+        classes = [classes[0][:-1], classes[1], coords[-1:]]
+    return [c for c in classes if len(c)]
+
+
+def step_coloured(
+    grid,
+    lose, loss_threshold,
+    overlap_x=True, overlap_y=True,
+    nh_seed="01010101", nh_order="01234567",
+    pool=None, bands=1,
+):
+    """Update `grid` in place, one colour class of cells after another.
+
+        Cells are coloured by the parity of their coordinates (4 colours, up
+        to 9 for odd lengths on wrapping axes), so no two cells of a class are
+        neighbours. Later classes see the already updated earlier classes,
+        while all cells of a class are updated at once. The result is
+        therefore independent of the number of bands.
+
+        See step() for the arguments.
+    """
+    y_classes = colour_classes(grid.shape[0], overlap_y)
+    x_classes = colour_classes(grid.shape[1], overlap_x)
+
+    for rows_class in y_classes:
+        for cols in x_classes:
+
+            def update_band(rows):
+                grid[np.ix_(rows, cols)] = defend_cells(
+                    grid, rows, cols,
+                    lose, loss_threshold,
+                    overlap_x=overlap_x, overlap_y=overlap_y,
+                    nh_seed=nh_seed, nh_order=nh_order,
+                )
+
+            run_bands(update_band, rows_class, pool=pool, bands=bands)
+
+
+def to_image(grid, palette):
+    """Turn weapon indices back into a palette image."""
+    img = Image.frombytes("P", (grid.shape[1], grid.shape[0]), grid.tobytes())
+    img.putpalette(palette)
+    return img
+
+
+def weapon_palette(img, levels):
+    """The flat [r, g, b, ...] palette of a discretized image, `levels` colors long."""
+    palette = img.getpalette()[:levels * 3]
+    return palette + [0] * (levels * 3 - len(palette))
+
+
+def frame_indices(frame, ref):
+    """Weapon indices of a saved frame, mapped onto the palette of `ref`."""
+    if frame.mode == "P" and frame.getpalette() == ref.getpalette():
+        return np.array(frame)
+    return np.array(frame.convert("RGB").quantize(palette=ref, dither=Image.Dither.NONE))
+
+
 def discretize(src, levels):
     out = src.convert('P', palette=Image.ADAPTIVE, colors=levels)
     p_ = out.getpalette()
@@ -157,9 +424,198 @@ def gen_file_name(loc_path, number, total):
     ) + str(number) + ".png"
 
 
+def numbered_files(loc_path):
+    """Paths of the numbered images in loc_path, ordered by their number."""
+    numbered = []
+    for f in os.listdir(loc_path):
+        number = f.split(".")[0]
+        if f.endswith(".png") and number.isdigit():
+            numbered.append((int(number), loc_path + "/" + f))
+    return [path for _, path in sorted(numbered)]
+
+
+def parse_nh_seed(nh_seed):
+    """Pad the neighbourhood seed with 0 to NUM_NEIGHBOURS chars or cut it off."""
+    # Turn on or of neighbours ability to attack
+    return str(nh_seed + "0"*max(0, NUM_NEIGHBOURS - len(nh_seed)))[:NUM_NEIGHBOURS]
+
+
+def parse_nh_order(nh_order):
+    """Turn the neighbourhood ordering numbers into the order in which neighbours attack.
+
+        nh_order:
+            (str)
+            Position in the order for each neighbourhood index, padded with the
+            remaining numbers in ascending order.
+
+        RETURNS
+        (str) The neighbourhood indexes in the order of attack.
+    """
+    # Change the order of attack by defining their position in the order by index
+    _nho = str(nh_order[:max(len(nh_order), NUM_NEIGHBOURS)])
+
+    # Keep track of unfilled with None
+    order_mapping = [None]*NUM_NEIGHBOURS
+    # Itterate over the neighbourhood index
+    for neighbour_index in range(len(_nho)):
+        _char = _nho[neighbour_index]
+        if order_mapping[int(_char)] is not None:
+            # The positions assigned by the argument have to be unique
+            raise ValueError("No double values: {} at index {}".format(_char, neighbour_index))
+        elif int(_char) > NUM_NEIGHBOURS - 1:
+            raise ValueError("Ordering number can not exceed number of neighbours: {} > {}".format(_char, NUM_NEIGHBOURS))
+        else:
+            # The first position of the _nho defines the ordering of the top-left corner ...
+            # Use this ordering number to index the current i (top-left ...).
+            order_mapping[int(_char)] = neighbour_index
+
+    def first_remaining_ordering_number(order_mapping):
+        for ordering_number in range(NUM_NEIGHBOURS):
+            if order_mapping[ordering_number] is None:
+                return ordering_number
+
+    # if not all indexes were ordered
+    num_unordered = NUM_NEIGHBOURS - len(_nho)
+    if num_unordered > 0:
+        # add the remaining ordering numbers to the last neighbourhood indexes
+        first_unordered = len(_nho)
+        for offset in range(num_unordered):
+            # find the first remaining ordering number
+            ordering_number = first_remaining_ordering_number(order_mapping)
+            print("{}: {} + {}".format(ordering_number, first_unordered, offset))
+            order_mapping[ordering_number] = first_unordered + offset
+
+    return "".join(str(i) for i in order_mapping)
+
+
+def simulate(
+    grid,
+    iterations,
+    number_of_weapons,
+    weapon_range,
+    loss_threshold,
+    fixed_threshold,
+    overlap_x,
+    overlap_y,
+    nh_seed,
+    nh_order,
+    new_image,
+    first_iteration=1,
+    pool=None,
+    bands=1,
+    packed=False,
+    hashlife=None,
+    hashlife_nodes=1 << 20,
+):
+    """Run the vectorized update on weapon indices.
+
+        grid:
+            (numpy.ndarray)
+            Weapon indices the simulation starts from, not modified.
+        iterations:
+            (int)
+            The last iteration to compute.
+
+        OPTIONALS
+        first_iteration:
+            (int)
+            The first iteration to compute (the cycling threshold depends on it).
+        packed:
+            (bool)
+            Keep the state bit-packed (see packed.py), requires new_image 1
+            and at most 16 weapons.
+        hashlife:
+            (int)
+            Use the memoized quadtree engine (see hashlife.py) and only yield
+            every 2**hashlife-th and the last iteration. Requires new_image 1,
+            a fixed threshold and wrapping borders.
+        hashlife_nodes:
+            (int)
+            Memory cap of the quadtree engine in stored blocks.
+
+        See generate_images() and step() for the remaining arguments.
+
+        YIELDS
+        (iteration, numpy.ndarray) The weapon indices after each iteration,
+        bit-packed if `packed`. The array is reused, copy it to keep it.
+    """
+    if new_image == 0:
+        raise ValueError("Vectorized stepping requires --new-image 1 or 2.")
+    if hashlife is not None:
+        if new_image != 1 or not fixed_threshold or not (overlap_x and overlap_y):
+            raise ValueError("HashLife requires --new-image 1, a fixed threshold and wrapping borders.")
+        from hashlife import HashLife
+        engine = HashLife(
+            number_of_weapons, weapon_range, loss_threshold,
+            nh_seed=nh_seed, nh_order=nh_order,
+            max_nodes=hashlife_nodes,
+        )
+        iteration = first_iteration - 1
+        while iteration < iterations:
+            # jump to the next multiple of 2**hashlife
+            target = min(((iteration >> hashlife) + 1) << hashlife, iterations)
+            grid = engine.advance(grid, target - iteration)
+            iteration = target
+            yield iteration, grid
+        return
+
+    lose = lose_table(number_of_weapons, weapon_range)
+    width = grid.shape[1]
+    if packed:
+        bits = bits_per_cell(number_of_weapons)
+        if bits is None or new_image != 1:
+            raise ValueError("Packed stepping requires --new-image 1 and at most 16 weapons.")
+        grid = pack(grid, bits)
+    else:
+        grid = grid.copy()
+    grid_next = np.empty_like(grid)
+
+    for iteration in range(first_iteration, iterations + 1):
+        # change loss threshold based on iteration
+        if fixed_threshold:
+            _loss_threshold = loss_threshold
+        else:
+            _loss_threshold = iteration % loss_threshold
+
+        if new_image == 2:
+            step_coloured(
+                grid,
+                lose, _loss_threshold,
+                overlap_x=overlap_x, overlap_y=overlap_y,
+                nh_seed=nh_seed, nh_order=nh_order,
+                pool=pool, bands=bands,
+            )
+        elif packed:
+            step_packed(
+                grid, grid_next, width, bits,
+                lose, _loss_threshold,
+                overlap_x=overlap_x, overlap_y=overlap_y,
+                nh_seed=nh_seed, nh_order=nh_order,
+                pool=pool, bands=bands,
+            )
+            grid, grid_next = grid_next, grid
+        else:
+            step(
+                grid, grid_next,
+                lose, _loss_threshold,
+                overlap_x=overlap_x, overlap_y=overlap_y,
+                nh_seed=nh_seed, nh_order=nh_order,
+                pool=pool, bands=bands,
+            )
+            grid, grid_next = grid_next, grid
+        yield iteration, grid
+
+
 import numpy as np
 from PIL import Image
 import os
+import shutil
+from gif import GifWriter
+from stats import RunStats
+from cache import RunCache
+from packed import bits_per_cell, pack, unpack
+from pyramid import PyramidSink, pyramid_exists
+from liveview import LivePublisher
 def generate_images(
     img_path,
     iterations,
@@ -173,7 +629,19 @@ def generate_images(
     overlap_y,
     nh_seed,
     nh_order,
-    new_image
+    new_image,
+    threads=None,
+    gif="native",
+    stats=True,
+    regions_every=100,
+    cache_dir=None,
+    cache_size=1 << 30,
+    packed=False,
+    hashlife=None,
+    backend="auto",
+    pyramid_every=None,
+    tile_size=256,
+    live=None
 ):
     print("Running imca: rock-paper-scissor\n")
     print("> Number of weapons:\n  : " + str(number_of_weapons))
@@ -187,6 +655,44 @@ def generate_images(
     for i in range(len(nh_order)):
         print("  #{} -> NH-Index-{}".format(i, nh_order[i]))
     print("> New image:\n  : " + str(new_image))
+    print("> Threads:\n  : " + str(threads))
+    print("> GIF:\n  : " + str(gif))
+    print("> Statistics:\n  : " + str(stats))
+    print("> Cache:\n  : " + str(cache_dir))
+    print("> Packed:\n  : " + str(packed))
+    print("> HashLife:\n  : " + str(hashlife))
+    print("> Pyramid every:\n  : " + str(pyramid_every))
+    print("> Live view:\n  : " + str(live))
+
+    rule = {
+        "number_of_weapons": number_of_weapons,
+        "weapon_range": weapon_range,
+        "loss_threshold": loss_threshold,
+        "fixed_threshold": fixed_threshold,
+        "overlap_x": overlap_x,
+        "overlap_y": overlap_y,
+        "nh_seed": nh_seed,
+        "nh_order": nh_order,
+        "new_image": new_image,
+    }
+    if backend == "auto":
+        # the options only one backend implements
+        if hashlife is not None:
+            backend = "hashlife"
+        elif packed:
+            backend = "packed"
+        elif threads is not None:
+            backend = "threads"
+        elif log_dist is not None:
+            # only the per-pixel update reports progress
+            backend = "reference"
+    # registers the backends, imports this module itself
+    from backends import get_backend
+    stepper = get_backend(
+        backend, rule,
+        threads=threads, log_dist=log_dist, packed=packed or None, hashlife=hashlife
+    )
+    print("> Backend:\n  : " + stepper.NAME)
 
     print("> Loading image: " + img_path)
     img = Image.open(img_path)
@@ -213,148 +719,227 @@ def generate_images(
 
     print(">>> " + loc_path)
 
-    iteration = 1
-
-    if os.path.isdir(loc_path):
-        d = input("Directory already exists. Create anyway? [y/n/continue] ")
-        if d.lower() in ["c", "continue"]:
-            max_it = 0
-            load_file = ""
-            for f in os.listdir(loc_path):
-                print(f)
-                # find largest existing iteration
-                if not os.path.isfile(loc_path + "/" + f):
-                    continue
-                try:
-                    # get only the number component
-                    new_ = int(f.split(".")[0])
-                    if new_ > max_it:
-                        load_file = f
-                        max_it = new_
-                except Exception:
-                    continue
-            # last iteration and the image of that iteration
-            iteration = max_it + 1
-            load_path = loc_path + '/' + load_file
-
-            # ask user how to proceed
-            if iteration < iterations:
-                d = input("{iteration}(+initial) iterations exist. Add {iterations} more (1) or fill up to {iterations} (2): ".format(
-                    iteration=iteration-1,
-                    iterations=iterations
-                ))
-                if d == "1":
-                    iterations = iterations + iteration
-                elif d == "2":
-                    # Nothing needed to do.
-                    pass
+    live_publisher = None
+    gif_writer = None
+    pyramid_sink = None
+    if live is not None:
+        # before anything is written, the name may be taken by a running simulation
+        live_publisher = LivePublisher(live, (img.height, img.width), weapon_palette(img, number_of_weapons))
+
+    try:
+        iteration = 1
+
+        if os.path.isdir(loc_path):
+            d = input("Directory already exists. Create anyway? [y/n/continue] ")
+            if d.lower() in ["c", "continue"]:
+                max_it = 0
+                load_file = ""
+                for f in os.listdir(loc_path):
+                    print(f)
+                    # find largest existing iteration
+                    if not os.path.isfile(loc_path + "/" + f):
+                        continue
+                    try:
+                        # get only the number component
+                        new_ = int(f.split(".")[0])
+                        if new_ > max_it:
+                            load_file = f
+                            max_it = new_
+                    except Exception:
+                        continue
+                # last iteration and the image of that iteration
+                iteration = max_it + 1
+                load_path = loc_path + '/' + load_file
+
+                # ask user how to proceed
+                if iteration < iterations:
+                    d = input("{iteration}(+initial) iterations exist. Add {iterations} more (1) or fill up to {iterations} (2): ".format(
+                        iteration=iteration-1,
+                        iterations=iterations
+                    ))
+                    if d == "1":
+                        iterations = iterations + iteration
+                    elif d == "2":
+                        # Nothing needed to do.
+                        pass
+                    else:
+                        print("Not an option! Exit...")
+                        return
                 else:
-                    print("Not an option! Exit...")
-                    return
+                    d = input("{iteration}(+initial) iterations exist. Add {iterations}? [y/n] ".format(
+                        iteration=iteration-1,
+                        iterations=iterations
+                    ))
+                    if d in ["y", "Y"]:
+                        iterations = iterations + iteration
+                    else:
+                        print("Exit...")
+                        return
+                print("Starting: {}/{}".format(iteration, iterations))
+
+                # LOAD IMAGE ------------------------------
+                print("Loading " + load_path)
+                img, weapons = discretize(Image.open(load_path), number_of_weapons)
+
+            elif d in ["y", "Y"]:
+                from shutil import rmtree
+                abs_path=os.path.abspath(loc_path)
+                rmtree(abs_path)
+                os.mkdir(loc_path)
             else:
-                d = input("{iteration}(+initial) iterations exist. Add {iterations}? [y/n] ".format(
-                    iteration=iteration-1,
-                    iterations=iterations
-                ))
-                if d in ["y", "Y"]:
-                    iterations = iterations + iteration
-                else:
-                    print("Exit...")
-                    return
-            print("Starting: {}/{}".format(iteration, iterations))
-
-            # LOAD IMAGE ------------------------------
-            print("Loading " + load_path)
-            img, weapons = discretize(Image.open(load_path), number_of_weapons)
-
-        elif d in ["y", "Y"]:
-            from shutil import rmtree
-            abs_path=os.path.abspath(loc_path)
-            rmtree(abs_path)
-            os.mkdir(loc_path)
+                print("Aborted!")
+                return
         else:
-            print("Aborted!")
-            return
-    else:
-        os.mkdir(loc_path)
+            os.mkdir(loc_path)
 
-    total_pixels = img.width * img.height
+        run_cache = None
+        restored = []
+        if cache_dir is not None and stepper.SPARSE:
+            print("> Cache skipped, the {} backend does not compute every iteration".format(stepper.NAME))
+        elif cache_dir is not None:
+            run_cache = RunCache(cache_dir, max_bytes=cache_size)
+            cache_params = {
+                "engine": ENGINE_VERSION,
+                "number_of_weapons": number_of_weapons,
+                "weapon_range": list(weapon_range),
+                "loss_threshold": loss_threshold,
+                "fixed_threshold": int(fixed_threshold),
+                "overlap_x": int(overlap_x),
+                "overlap_y": int(overlap_y),
+                "nh_seed": nh_seed,
+                "nh_order": nh_order,
+                "new_image": new_image,
+            }
+            cache_key = RunCache.key(img_path, cache_params)
+            print("> Cache key:\n  : " + cache_key)
 
-    _l_t = loss_threshold
+            if iteration == 1:
+                # continue from the last cached frame
+                for number, path in enumerate(run_cache.frames(cache_key)[:iterations + 1]):
+                    file_name = gen_file_name(loc_path, number, iterations + 1)
+                    shutil.copyfile(path, file_name)
+                    restored.append(file_name)
+                if restored:
+                    print("\tRestored {} frames from cache".format(len(restored)))
+                    img = Image.open(restored[-1])
+                    iteration = len(restored)
 
-    # save initial image as well
-    if iteration == 1:
-        # Only if not a continuation from before
-        file_name = gen_file_name(loc_path, 0, iterations + 1)
-        img.save(
-            file_name,
-            "PNG"
-        )
-        print("\tSaved to " + file_name)
-
-    # generate following images
-    for iteration in range(iteration, iterations + 1):
-        print("Iteration {}/{};".format(
-            "0"*(len(str(iterations)) - len(str(iteration))) + str(iteration),
-            iterations
-        ))
-
-        # The source image to look up weapons
-        img_ref=None
-        if new_image:
-            # store previous values separately
-            img_ref = img.copy()
-        else:
-            # read values from the changing image
-            img_ref = img
-
-        finished_pixels = 0
-        current_progress = -1
-
-        # loop over coordinates
-        for x, y in np.ndindex(img.size):
-            # log progress
-            if log_dist is not None:
-                progress = (finished_pixels / total_pixels) * 100
-                if current_progress != progress and ( progress % log_dist) == 0:
-                    current_progress = progress
-                    print("\tPixel {}/{}".format(
-                        "0"*(len(str(total_pixels)) - len(str(finished_pixels))) + str(finished_pixels),
-                        total_pixels
-                    ))
+        # save initial image as well
+        if iteration == 1 and not restored:
+            # Only if not a continuation from before
+            file_name = gen_file_name(loc_path, 0, iterations + 1)
+            img.save(
+                file_name,
+                "PNG"
+            )
+            print("\tSaved to " + file_name)
+            if run_cache is not None:
+                run_cache.append(cache_key, 0, file_name, cache_params)
 
-            # change loss threshold based on iteration
-            if not fixed_threshold:
-                loss_threshold = iteration % _l_t
-
-            # set each pixel by channel
-            img.putpixel(
-                xy=(x,y),
-                value=defend_against_neighbours(
-                    xy=(x,y),
-                    src=img_ref,
-                    number_of_weapons=number_of_weapons,
-                    weapon_range=weapon_range,
-                    loss_threshold=loss_threshold,
-                    overlap_x=overlap_x,
-                    overlap_y=overlap_y,
-                    nh_seed=nh_seed,
-                    nh_order=nh_order,
-                )
+        previous = np.array(img)
+        if stats:
+            run_stats = RunStats(number_of_weapons, regions_every=regions_every)
+            if restored:
+                restored_previous = None
+                for number, file_name in enumerate(restored):
+                    restored_current = np.array(Image.open(file_name))
+                    run_stats.record(number, restored_current, restored_previous)
+                    restored_previous = restored_current
+            elif iteration == 1:
+                run_stats.record(0, previous)
+
+        if gif == "native":
+            # stream frames into the gif as they are computed
+            gif_writer = GifWriter(
+                loc_path + ".gif",
+                img.size,
+                weapon_palette(img, number_of_weapons)
             )
-            finished_pixels += 1
+            # starting with those already on disk
+            for file_name in numbered_files(loc_path):
+                gif_writer.add_frame(frame_indices(Image.open(file_name), img))
 
-        # save after every pixel has been updated
-        file_name = gen_file_name(loc_path, iteration, iterations + 1)
-        img.save(
-            file_name,
-            "PNG"
-        )
-        print("\tSaved to " + file_name)
+        if pyramid_every is not None:
+            # tiles are written on another process while the simulation runs
+            pyramid_sink = PyramidSink(
+                loc_path + "/pyramid",
+                weapon_palette(img, number_of_weapons),
+                every=pyramid_every,
+                tile_size=tile_size
+            )
+            # including frames restored from the cache or of a continued run
+            for file_name in numbered_files(loc_path):
+                number = int(os.path.basename(file_name).split(".")[0])
+                if number % pyramid_every == 0 and not pyramid_exists(loc_path + "/pyramid/" + str(number)):
+                    pyramid_sink.add(number, frame_indices(Image.open(file_name), img))
+
+        if live is not None:
+            # observers read the latest iteration with liveview.py,
+            # a continued run discretizes its last frame anew
+            live_publisher.set_palette(weapon_palette(img, number_of_weapons))
+            live_publisher.publish(iteration - 1, previous)
+
+        palette = img.getpalette()
+        steps = stepper.simulate(np.array(img), iterations, rule, first_iteration=iteration)
+
+        # generate following images
+        for iteration, state in steps:
+            print("Iteration {}/{};".format(
+                "0"*(len(str(iterations)) - len(str(iteration))) + str(iteration),
+                iterations
+            ))
+            # packed states are only unpacked here, to be rendered
+            grid = stepper.to_grid(state)
+            img = to_image(grid, palette)
 
-    # Generate GIF
-    os.system("ffmpeg -i "+loc_path+"/%0"+str(len(str(iterations)))+"d.png "+loc_path+".gif")
-    print("Wrote gif to "+loc_path+".gif")
+            # save after every pixel has been updated
+            file_name = gen_file_name(loc_path, iteration, iterations + 1)
+            img.save(
+                file_name,
+                "PNG"
+            )
+            print("\tSaved to " + file_name)
+            if run_cache is not None:
+                run_cache.append(cache_key, iteration, file_name, cache_params)
+
+            current = grid.copy()
+            if stats:
+                run_stats.record(iteration, current, previous)
+            if gif == "native":
+                gif_writer.add_frame(current)
+            if pyramid_every is not None:
+                pyramid_sink.add(iteration, current)
+            if live is not None:
+                live_publisher.publish(iteration, current)
+            previous = current
+
+        if run_cache is not None:
+            run_cache.evict(keep=cache_key)
+
+        if pyramid_every is not None:
+            pyramid_sink.close()
+            pyramid_sink = None
+            print("Wrote pyramids to " + loc_path + "/pyramid")
+
+        if stats:
+            run_stats.save(loc_path + ".stats.npz")
+            print("Wrote statistics to " + loc_path + ".stats.npz")
+
+        # Generate GIF
+        if gif == "native":
+            gif_writer.close()
+            gif_writer = None
+        else:
+            os.system("ffmpeg -i "+loc_path+"/%0"+str(len(str(iterations)))+"d.png "+loc_path+".gif")
+        print("Wrote gif to "+loc_path+".gif")
+    finally:
+        # also on errors and interrupts, none of them is left open
+        if live_publisher is not None:
+            live_publisher.close()
+        if pyramid_sink is not None:
+            pyramid_sink.close()
+        if gif_writer is not None:
+            gif_writer.close()
 
 
 # ENTRY =============================================================
@@ -402,7 +987,7 @@ if __name__ == "__main__":
         "--log-dist",
         metavar="LOG_DIST",
         dest="log_dist",
-        help="Progress is reported in LOG_DIST % steps. (None->No logging)",
+        help="Progress of the per-pixel update (reference backend) is reported in LOG_DIST % steps. (None->No logging)",
         default=None,
         type=int
     )
@@ -450,10 +1035,107 @@ if __name__ == "__main__":
         "--new-image",
         metavar="NEW_IMAGE",
         dest="new_image",
-        help="Whether or not (1/0) to calculate the results from a copy of the picture (otherwise on same image).",
+        help="Whether or not (1/0) to calculate the results from a copy of the picture (otherwise on same image). 2 updates the same image in colour classes of non-neighbouring pixels (deterministic for any --threads).",
         default=1,
         type=int
     )
+    parser.add_argument(
+        "--threads",
+        metavar="THREADS",
+        dest="threads",
+        help="Update the whole grid at once in THREADS horizontal bands on a thread pool. Requires --new-image 1 or 2. (None->see --backend)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--gif",
+        metavar="GIF",
+        dest="gif",
+        help="How to write the gif: native (delta frames on the simulation palette) or ffmpeg (from the saved images).",
+        default="native",
+        choices=["native", "ffmpeg"],
+        type=str
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="STATS",
+        dest="stats",
+        help="Whether or not (1/0) to write per-iteration statistics next to the output directory.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--regions-every",
+        metavar="K",
+        dest="regions_every",
+        help="Count connected regions every K iterations for the statistics. (0->never)",
+        default=100,
+        type=int
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="CACHE_DIR",
+        dest="cache_dir",
+        help="Reuse and extend frames of earlier runs with the same input and rule stored in CACHE_DIR. (None->No cache)",
+        default=None,
+        type=str
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="MB",
+        dest="cache_size",
+        help="Disk budget of the cache in MB, least recently used runs are removed beyond it.",
+        default=1024,
+        type=int
+    )
+    parser.add_argument(
+        "--packed",
+        metavar="PACKED",
+        dest="packed",
+        help="Whether or not (1/0) to keep the grid bit-packed (2 or 4 bits per pixel). Requires --new-image 1 and --nw <= 16.",
+        default=0,
+        type=int
+    )
+    parser.add_argument(
+        "--hashlife",
+        metavar="K",
+        dest="hashlife",
+        help="Use the memoized quadtree engine and only save every 2**K-th and the last iteration. Requires --new-image 1, --f-lt 1 and wrapping borders. (None->every iteration)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--backend",
+        metavar="BACKEND",
+        dest="backend",
+        help="Implementation of the update: auto, reference, numpy, threads, packed or hashlife (see backends.py).",
+        default="auto",
+        type=str
+    )
+    parser.add_argument(
+        "--pyramid-every",
+        metavar="K",
+        dest="pyramid_every",
+        help="Write every K-th frame as tiled multi-resolution pyramid to <out>/pyramid/<frame>, see pyramid.py. (None->never)",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--tile-size",
+        metavar="SIZE",
+        dest="tile_size",
+        help="Width and height of the pyramid tiles.",
+        default=256,
+        type=int
+    )
+    parser.add_argument(
+        "--live",
+        metavar="NAME",
+        dest="live",
+        help="Publish every iteration to the shared memory segment NAME, read it with liveview.py. (None->off)",
+        default=None,
+        type=str
+    )
     parser.add_argument(
         "--nh-order",
         metavar="ORDER",
@@ -472,44 +1154,8 @@ if __name__ == "__main__":
     # | 654 |
     # +-----+
 
-    # Turn on or of neighbours ability to attack
-    _nhs = args.nh_seed
-    args.nh_seed = str(_nhs + "0"*max(0, NUM_NEIGHBOURS - len(_nhs)))[:NUM_NEIGHBOURS]
-
-    # Change the order of attack by defining their position in the order by index
-    _nho = args.nh_order
-    _nho = str(_nho[:max(len(_nho), NUM_NEIGHBOURS)])
-
-    # Keep track of unfilled with None
-    order_mapping = [None]*NUM_NEIGHBOURS
-    # Itterate over the neighbourhood index
-    for neighbour_index in range(len(_nho)):
-        _char = _nho[neighbour_index]
-        if order_mapping[int(_char)] is not None:
-            # The positions assigned by the argument have to be unique
-            raise ValueError("No double values: {} at index {}".format(_char, neighbour_index))
-        elif int(_char) > NUM_NEIGHBOURS - 1:
-            raise ValueError("Ordering number can not exceed number of neighbours: {} > {}".format(_char, NUM_NEIGHBOURS))
-        else:
-            # The first position of the _nho defines the ordering of the top-left corner ...
-            # Use this ordering number to index the current i (top-left ...).
-            order_mapping[int(_char)] = neighbour_index
-
-    def first_remaining_ordering_number(order_mapping):
-        for ordering_number in range(NUM_NEIGHBOURS):
-            if order_mapping[ordering_number] is None:
-                return ordering_number
-
-    # if not all indexes were ordered
-    num_unordered = NUM_NEIGHBOURS - len(_nho)
-    if num_unordered > 0:
-        # add the remaining ordering numbers to the last neighbourhood indexes
-        first_unordered = len(_nho)
-        for offset in range(num_unordered):
-            # find the first remaining ordering number
-            ordering_number = first_remaining_ordering_number(order_mapping)
-            print("{}: {} + {}".format(ordering_number, first_unordered, offset))
-            order_mapping[ordering_number] = first_unordered + offset
+    args.nh_seed = parse_nh_seed(args.nh_seed)
+    args.nh_order = parse_nh_order(args.nh_order)
 
     print(args)
 
@@ -525,6 +1171,18 @@ if __name__ == "__main__":
         overlap_x=args.overlap_x,
         overlap_y=args.overlap_y,
         nh_seed=args.nh_seed,
-        nh_order="".join(str(i) for i in order_mapping),
-        new_image=args.new_image
+        nh_order=args.nh_order,
+        new_image=args.new_image,
+        threads=args.threads,
+        gif=args.gif,
+        stats=args.stats,
+        regions_every=args.regions_every,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size * (1 << 20),
+        packed=args.packed,
+        hashlife=args.hashlife,
+        backend=args.backend,
+        pyramid_every=args.pyramid_every,
+        tile_size=args.tile_size,
+        live=args.live
     )
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Purpose:    Per-iteration population statistics of a running simulation.
+
+Everything is computed from the weapon indices of two consecutive
+iterations and written as one column per statistic into a .npz file.
+"""
+import os
+
+import numpy as np
+
+
+def count_regions(grid):
+    """Number of 4-connected regions of equal weapons (borders do not wrap).
+
+        grid:
+            (numpy.ndarray)
+            Weapon indices, indexed [y, x].
+    """
+    # runs of equal weapons within each row are connected already
+    starts = np.ones(grid.shape, dtype=bool)
+    starts[:, 1:] = grid[:, 1:] != grid[:, :-1]
+    run_id = np.cumsum(starts.ravel()).reshape(grid.shape) - 1
+    number_of_runs = int(run_id[-1, -1]) + 1
+
+    # runs touching the equal run below
+    same = grid[1:] == grid[:-1]
+    edges = np.unique(run_id[:-1][same] * number_of_runs + run_id[1:][same])
+    a = edges // number_of_runs
+    b = edges % number_of_runs
+
+    # hook the larger root onto the smaller one and compress until stable
+    labels = np.arange(number_of_runs)
+    while True:
+        label_a = labels[a]
+        label_b = labels[b]
+        lowest = np.minimum(label_a, label_b)
+        hooked = labels.copy()
+        np.minimum.at(hooked, label_a, lowest)
+        np.minimum.at(hooked, label_b, lowest)
+        while True:
+            compressed = hooked[hooked]
+            if (compressed == hooked).all():
+                break
+            hooked = compressed
+        if (hooked == labels).all():
+            break
+        labels = hooked
+
+    return int(np.count_nonzero(labels == np.arange(number_of_runs)))
+
+
+class RunStats():
+    """Collect statistics for every iteration and save them column-wise.
+
+        Columns:
+            iteration:  (n,)        The iteration.
+            population: (n, nw)     Number of cells per weapon.
+            changed:    (n,)        Number of cells that changed their weapon.
+            wins:       (n, nw, nw) [winner, loser] cells taken by winner from loser.
+            regions:    (n,)        Connected regions, -1 if not sampled.
+    """
+
+    COLUMNS = ["iteration", "population", "changed", "wins", "regions"]
+
+    def __init__(self, number_of_weapons, regions_every=100):
+        """Start an empty collection.
+
+            number_of_weapons:
+                (int)
+                Number of weapons of the simulation.
+
+            OPTIONALS
+            regions_every:
+                (int)
+                Count connected regions every REGIONS_EVERY iterations (0->never).
+        """
+        self.number_of_weapons = number_of_weapons
+        self.regions_every = regions_every
+        self.columns = {column: [] for column in self.COLUMNS}
+
+    def record(self, iteration, current, previous=None):
+        """Add the statistics of one iteration.
+
+            iteration:
+                (int)
+                The iteration that produced `current`.
+            current:
+                (numpy.ndarray)
+                Weapon indices after the iteration.
+
+            OPTIONALS
+            previous:
+                (numpy.ndarray)
+                Weapon indices before the iteration, None for the initial image.
+        """
+        nw = self.number_of_weapons
+        population = np.bincount(current.ravel(), minlength=nw)[:nw]
+
+        if previous is None:
+            changed = 0
+            wins = np.zeros((nw, nw), dtype=np.int64)
+        else:
+            mask = current != previous
+            changed = int(np.count_nonzero(mask))
+            # transitions loser -> winner of the changed cells
+            transitions = previous[mask].astype(np.int64) * nw + current[mask]
+            wins = np.bincount(transitions, minlength=nw * nw)[:nw * nw].reshape(nw, nw).T
+
+        regions = -1
+        if self.regions_every and iteration % self.regions_every == 0:
+            regions = count_regions(current)
+
+        self.columns["iteration"].append(iteration)
+        self.columns["population"].append(population)
+        self.columns["changed"].append(changed)
+        self.columns["wins"].append(wins)
+        self.columns["regions"].append(regions)
+
+    def save(self, path):
+        """Write the columns to `path` (.npz).
+
+            Rows of earlier iterations already stored at `path` are kept, so
+            continued runs extend the file.
+        """
+        columns = {
+            "iteration": np.array(self.columns["iteration"], dtype=np.int64),
+            "population": np.array(self.columns["population"], dtype=np.uint32).reshape(-1, self.number_of_weapons),
+            "changed": np.array(self.columns["changed"], dtype=np.uint32),
+            "wins": np.array(self.columns["wins"], dtype=np.uint32).reshape(-1, self.number_of_weapons, self.number_of_weapons),
+            "regions": np.array(self.columns["regions"], dtype=np.int32),
+        }
+        if os.path.isfile(path) and len(columns["iteration"]):
+            with np.load(path) as stored:
+                keep = stored["iteration"] < columns["iteration"].min()
+                columns = {
+                    column: np.concatenate([stored[column][keep], columns[column]])
+                    for column in self.COLUMNS
+                }
+        # np.savez appends .npz to names without it
+        with open(path, "wb") as out_file:
+            np.savez_compressed(out_file, **columns)